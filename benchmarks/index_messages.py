@@ -0,0 +1,72 @@
+#!/usr/bin/env -S python3
+"""
+BlindDataFrames.index_messages (ColumnBuilder) against the previous list-per-key implementation.
+
+    python -m benchmarks.index_messages [MESSAGES]    # default 1,000,000
+
+Messages carry three numeric fields and one text field in every message (the old builder can't
+align sparse fields) plus, for the new builder only, a field present in 1% of messages.
+"""
+import sys
+import tracemalloc
+from time import perf_counter, time
+
+from pandas import DataFrame
+from walrus import Message
+
+from botcannon.stream_frame import ColumnBuilder
+
+
+def legacy_index_messages(messages):
+    frames = {}
+    index = {}
+
+    def func(msg):
+        for stream_key in msg.data:
+            if stream_key in frames:
+                frames[stream_key].append(msg.data[stream_key])
+            else:
+                frames[stream_key] = [msg.data[stream_key]]
+            if stream_key in index:
+                index[stream_key].append(msg.timestamp)
+            else:
+                index[stream_key] = [msg.timestamp]
+
+    [func(i) for i in messages]
+
+    dfs = {}
+    for key in index:
+        f = DataFrame(frames, index=index[key])
+        dfs[key] = f
+    return dfs
+
+
+def messages(n, sparse):
+    start = int(time() * 1000) - n
+    for i in range(n):
+        data = {b'price': f'{i * 0.01:.2f}'.encode(), b'volume': str(i % 977).encode(),
+                b'latency': f'{(i % 131) / 7:.3f}'.encode(), b'user': f'user{i % 50}'.encode()}
+        if sparse and not i % 100:
+            data[b'error'] = b'1'
+        yield Message(b'bench', f'{start + i}-0'.encode(), data)
+
+
+def run(name, fn, msgs):
+    t = perf_counter()
+    fn(msgs)
+    elapsed = perf_counter() - t
+
+    tracemalloc.start()  # separate pass, tracing slows allocation-heavy code down a lot
+    fn(msgs)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    print(f'{name:<16} {elapsed:>8.2f}s {peak / 1024 ** 2:>10.0f}MB')
+
+
+if __name__ == '__main__':
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+    dense = list(messages(n, sparse=False))
+    print(f'{n} messages{"":<4} {"time":>8} {"peak mem":>11}')
+    run('legacy', legacy_index_messages, dense)
+    run('ColumnBuilder', lambda m: ColumnBuilder().extend(m).frame(), dense)
+    run('ColumnBuilder+1%', lambda m: ColumnBuilder().extend(m).frame(), list(messages(n, sparse=True)))
@@ -0,0 +1,68 @@
+#!/usr/bin/env -S python3
+"""
+Startup cost of the pieces that are started most often.
+
+    python benchmarks/startup.py            # imports + `botcannon help`, no redis needed
+    python benchmarks/startup.py SERVICE    # also time TaskWorker setup against $BOTCANNON_REDIS, ./sockets or /run/redis
+
+Each import and the CLI are timed in a fresh interpreter so nothing is already cached.
+"""
+import os
+import subprocess
+import sys
+from statistics import median
+from time import perf_counter
+
+RUNS = 10
+
+IMPORTS = {
+    'import botcannon': 'import botcannon',
+    'import worker': 'import botcannon.multiprocess',
+}
+# a real command that never connects, BotCannon() only needs to know where redis would be
+CLI = [sys.executable, '-m', 'botcannon', 'help']
+
+
+def timed(args, env=None):
+    """Median wall time of running args in a fresh process, and the last run's stdout."""
+    times = []
+    for _ in range(RUNS):
+        t = perf_counter()
+        out = subprocess.run(args, capture_output=True, text=True, check=True, env=env)
+        times.append(perf_counter() - t)
+    return median(times), out.stdout
+
+
+def cold(stmt):
+    """Median wall time of a fresh interpreter running stmt, and whether pandas got imported."""
+    ms, out = timed([sys.executable, '-c', f'{stmt}\nimport sys; print("pandas" in sys.modules)'])
+    return ms, out.strip() == 'True'
+
+
+def cli():
+    env = {**os.environ, 'BOTCANNON_REDIS': os.environ.get('BOTCANNON_REDIS', 'redis://127.0.0.1:6379/0')}
+    return timed(CLI, env)[0]
+
+
+def worker_setup(service_name):
+    from botcannon.multiprocess import TaskWorker
+
+    times = []
+    for _ in range(RUNS):
+        w = TaskWorker(service_name, 1000, 1)
+        t = perf_counter()
+        w.setup()
+        times.append(perf_counter() - t)
+    return median(times), 'pandas' in sys.modules
+
+
+if __name__ == '__main__':
+    print(f'{"":<20} {"median ms":>10}  pandas')
+    for name, stmt in IMPORTS.items():
+        ms, pandas = cold(stmt)
+        print(f'{name:<20} {ms * 1000:>10.1f}  {pandas}')
+    print(f'{"botcannon help":<20} {cli() * 1000:>10.1f}  -')
+
+    if len(sys.argv) > 1:
+        ms, pandas = worker_setup(sys.argv[1])
+        print(f'{"TaskWorker.setup":<20} {ms * 1000:>10.1f}  {pandas}')
@@ -1,30 +1,28 @@
 #!/usr/bin/env -S python3
+import asyncio
 import inspect
 from pathlib import Path
 from getpass import getpass
 import datetime
-from time import sleep
+import json
 import multiprocessing as mp
+import os
+import socket
+import threading
 
-from walrus import Database
 from ruamel.yaml import YAML
 
+from . import transport
 from .config import ConfigManager
 from .services import BotCannonService
 from .models import Collector
 
 class BotCannon:
     """"""
-    def __init__(self, namespace='DEFAULT', lib_dir='./app'):
-        self._system_path = Path('/run/redis/redis-server.sock')  # or system
-        self._relative_path = Path('.') / 'sockets/redis-server.sock'
-        socket_path = self._system_path if self._system_path.exists() else None
-        if self._relative_path.exists():
-            socket_path = self._relative_path
-        if not socket_path:
-            print(f'No redis socket in {self._system_path} OR {self._relative_path}.')
-            exit(1)
-        self._socket_path = socket_path
+    def __init__(self, namespace='DEFAULT', lib_dir='./app', redis_url=None):
+        # unix socket, tcp or sentinel, see botcannon.transport. worker processes find it in the environment
+        self._redis_url = transport.redis_url(redis_url)
+        os.environ['BOTCANNON_REDIS'] = self._redis_url
         self._namespace = namespace
         self._lib_dir = lib_dir
         self._service_kwargs = {}
@@ -47,7 +45,7 @@ class BotCannon:
         self.init(service_name)
         return self._service
 
-    def init(self, service_name):
+    def init(self, service_name, consumer_name=None):
         """To delay connections to redis"""
         from importlib import reload
         paths_dict = {}
@@ -59,46 +57,73 @@ class BotCannon:
         self._service_kwargs = {
             'namespace': self._namespace,
             'paths_dict': paths_dict,
-            'socket_path': self._socket_path,
+            'redis_url': self._redis_url,
             'lib_dir': self._lib_dir,
             'hardfail': True,
         }
 
-        self._service = BotCannonService(service_name, **self._service_kwargs)
+        self._service = BotCannonService(service_name, consumer_name=consumer_name, **self._service_kwargs)
         return self._service
 
-    def up(self, service_name, lazy=False):
+    def up(self, service_name, lazy=False, partitions=None, budget=8):
+        """
+        Run a service's collector and workers. `partitions` lists the data partitions this host's workers read.
+        Given a list of services (or 'all'), runs them all under one Supervisor, see up_many.
+        """
+        if service_name == 'all' or isinstance(service_name, (list, tuple)):
+            return self.up_many(service_name, lazy, budget)
+
         from .multiprocess import ManageWorkers
 
         s = self.init(service_name)
         q = mp.Queue(maxsize=2)
-        p = ManageWorkers(s.ledger.service_name, q, 60)
-
-        print("Initializing collector process")
-        collector, collector_params = s.get_collector()
-        c = collector(**collector_params) if collector_params else collector()
+        partitions = [partitions] if isinstance(partitions, int) else partitions
+        p = ManageWorkers(s.ledger.service_name, q, 60, s.options.get('workers', {}), partitions)
 
         try:
-            while True:
-                t = True
-                for data in c.read():
-                    if data:
-                        if not lazy:
-                            q.put('hot')
-                            t = False
-                        s.ledger.write('data', data)
+            self._collect(s, q.put, lazy)
+
+        except KeyboardInterrupt:
+            print("Caught KeyboardInterrupt, terminating consumer")
+            q.put('killjobs')
+
+        finally:
+            q.put(None)
+            q.close()
+            p.join()
+            p.terminate()
+
+    def up_many(self, service_names='all', lazy=False, budget=8):
+        """
+        Several services in one process tree: their collectors run side by side in this process over one
+        redis connection pool and one copy of the plugins, their workers share `budget` worker processes.
+        """
+        from .multiprocess import Supervisor
+
+        if service_names == 'all':
+            service_names = sorted(i.name for i in ConfigManager(self._namespace,
+                                                                 transport.database(self._redis_url)).service.all())
+        services = [self.init(i) for i in service_names]
+        if not services:
+            print('No services to run.')
+            exit(1)
 
-                for taskback in s.ledger.channels["taskback"].read(block=None):
-                    c.taskback(taskback)
-                    s.ledger.channels["taskback"].ack(taskback.message_id)
-                    t = False
+        q = mp.Queue(maxsize=2 * len(services))
+        p = Supervisor([s.ledger.service_name for s in services], q, 60, budget)
 
-                if t:
-                    q.put('loop_done')
-                    sleep(0.005)
+        threads = []
+        for s in services:
+            put = (lambda name: lambda signal: q.put((name, signal)))(s.ledger.service_name)
+            threads.append(threading.Thread(target=self._collect, args=(s, put, lazy), daemon=True,
+                                            name=f'collector-{s.ledger.service_name}'))
+            threads[-1].start()
+
+        try:
+            while any(i.is_alive() for i in threads):
+                [i.join(1) for i in threads]
 
         except KeyboardInterrupt:
-            print("Caught KeyboardInterrupt, terminating consumer")
+            print("Caught KeyboardInterrupt, terminating consumers")
             q.put('killjobs')
 
         finally:
@@ -107,6 +132,71 @@ class BotCannon:
             p.join()
             p.terminate()
 
+    def _collect(self, s, put, lazy=False):
+        """A service's collector loop, sending 'hot' and 'loop_done' signals to its manager through put."""
+        print(f"Initializing collector for {s.ledger.service_name}")
+        collector, collector_params = s.get_collector()
+        c = collector(**collector_params) if collector_params else collector()
+
+        ingest = s.options.get('ingest', {})
+        size, flush_ms = int(ingest.get('batch', 500)), float(ingest.get('flush_ms', 5))
+        metrics = s.metrics(f'collector-{socket.gethostname()}-{os.getpid()}')
+
+        batch, runner, pump = None, None, None
+        if inspect.isasyncgenfunction(c.read):
+            from .aio import AsyncCollectorLoop
+            runner = AsyncCollectorLoop(s, c, put, lazy, size, flush_ms, metrics=metrics)
+        else:
+            # one pipelined XADD and one 'hot' signal per flush, rather than per message
+            batch = s.ledger.batch('data', size=size, flush_ms=flush_ms,
+                                   on_flush=None if lazy else lambda n: put(('hot', n)))
+            # taskbacks arrive on a blocking read in their own thread, no polling
+            pump = s.ledger.taskback_pump(count=int(ingest.get('taskback_count', 100)),
+                                          callback=c.taskback if getattr(c, 'threadsafe_taskback', False) else None,
+                                          metrics=metrics)
+        idle_wait = float(ingest.get('idle_ms', 100)) / 1000
+
+        try:
+            if runner:
+                asyncio.run(runner.run())
+
+            while batch:
+                collected = False
+                for data in c.read():
+                    if data:
+                        collected = True
+                        batch.add(data)
+                    pump.deliver(c.taskback)
+                batch.flush()
+
+                delivered = pump.deliver(c.taskback)
+                if lazy or not (collected or delivered):
+                    put('loop_done')  # lazy keeps reporting it so the manager starts idle workers
+                if not (collected or delivered):
+                    # nothing collected, sleep until a taskback shows up (or idle_ms passes)
+                    pump.deliver(c.taskback, wait=idle_wait)
+
+        finally:
+            batch.close() if batch else None
+            pump.close() if pump else None
+            metrics.close() if metrics else None
+
+    def stats(self, service_name, minutes=60):
+        """p50/p95/p99 of the timings workers and the collector flushed to the log stream, per task."""
+        from .metrics import summarize
+        s = self.init(service_name)
+        merged, rate = summarize(s.ledger, minutes=minutes)
+        if not merged:
+            print(f'No metrics in the last {minutes} minutes.')
+            return
+
+        print(f'{service_name}, last {minutes} minutes, {rate:.1f} msg/s')
+        print(''.join(f'{i:>10}' for i in ['count', 'p50', 'p95', 'p99', 'max']), '  metric/task (_ms in ms)')
+        for metric, task in sorted(merged):
+            h = merged[(metric, task)]
+            print(f'{h.count:>10}' + ''.join(f'{h.percentile(p):>10.1f}' for p in [50, 95, 99]) + f'{h.max:>10.1f}',
+                  f'  {metric}/{task}' if task else f'  {metric}')
+
     def yml(self, file_name, overwrite=True):
 
         y = YAML()
@@ -118,12 +208,14 @@ class BotCannon:
 
         conf = ConfigManager(
             namespace=self._namespace,
-            db=Database(
-                unix_socket_path=str(
-                    self._socket_path.resolve())))
+            db=transport.database(self._redis_url))
 
         root = compose['services']
 
+        # a bad task graph is refused here, before anything is written, rather than by every worker it starts
+        from .multiprocess import plan_tasks
+        [plan_tasks(root[i].get('tasks') or {}) for i in root]
+
         service_function_keys = ['collector', 'shell']
         service_config_keys = ['file', 'entry', 'conf']
 
@@ -216,7 +308,14 @@ class BotCannon:
                 service_model.tasks = yml_service["tasks"]
             else:
                 service_model.tasks = {}
+
+            # everything else under the service (workers, ...) is kept as plain options
+            options = {i: yml_service[i] for i in yml_service if i not in service_function_keys + ['tasks']}
+            if 'lifecycle' in yml_service['shell']:
+                options['shell'] = {'lifecycle': yml_service['shell']['lifecycle']}
+            service_model.options = json.loads(json.dumps(options))
             service_model.save()
+            conf.bump()
 
     def ls(self):
         # _services = [i for i in self.su.service.all()]
@@ -0,0 +1,121 @@
+import asyncio
+import inspect
+
+import redis.asyncio as aioredis
+from redis.asyncio.sentinel import Sentinel
+
+from . import transport
+
+
+def connect(url):
+    """redis.asyncio client for a transport url (see botcannon.transport), on a bounded pool of its own."""
+    if url.startswith('redis+sentinel://'):
+        hosts, master, kwargs = transport.parse_sentinel(url)
+        sentinel = Sentinel(hosts, sentinel_kwargs={'password': kwargs.get('password')})
+        return sentinel.master_for(master, max_connections=transport.MAX_CONNECTIONS, **kwargs)
+    return aioredis.Redis(connection_pool=aioredis.BlockingConnectionPool.from_url(
+        url, max_connections=transport.MAX_CONNECTIONS, timeout=transport.POOL_TIMEOUT))
+
+
+class AsyncCollectorLoop:
+    """
+    Event loop side of `up` for collectors whose read() is an async generator. Every source, the flusher
+    and the taskback reader are their own task, so ingest, taskback delivery and worker signalling overlap
+    and nothing waits on a fixed sleep.
+
+    :param put: sends a signal to the manager, e.g. its queue's put
+    :param size: flush the buffer once this many items are waiting
+    :param flush_ms: or once the oldest has waited this long
+    :param metrics: records the time from each taskback's write to its delivery
+    """
+    def __init__(self, service, collector, put, lazy=False, size=500, flush_ms=5.0, taskback_count=100, metrics=None):
+        self.service = service
+        self.ledger = service.ledger
+        self.collector = collector
+        self.put = put
+        self.lazy = lazy
+        self.size = max(1, size)
+        self.flush_ms = flush_ms
+        self.taskback_count = taskback_count
+        self.metrics = metrics
+
+        self.db = None
+        self.buffer = []
+        self._waiting = None  # set when the buffer gets its first item
+        self._full = None
+
+    async def signal(self, message):
+        # mp.Queue.put can block on a full queue, keep it off the event loop
+        await asyncio.get_running_loop().run_in_executor(None, self.put, message)
+
+    async def flush(self):
+        items, self.buffer = self.buffer, []
+        if not items:
+            return 0
+        pipe = self.db.pipeline(transaction=False)
+        [self.ledger._xadd(pipe, 'data', i) for i in items]
+        try:
+            await pipe.execute()
+        except Exception:
+            self.buffer = items + self.buffer  # back in front, to go out with the next flush
+            raise
+        if not self.lazy:
+            await self.signal(('hot', len(items)))
+        return len(items)
+
+    async def flusher(self):
+        while True:
+            await self._waiting.wait()
+            self._waiting.clear()
+            try:
+                await asyncio.wait_for(self._full.wait(), self.flush_ms / 1000)
+            except asyncio.TimeoutError:
+                pass
+            self._full.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                print(f'[!] Flush of {len(self.buffer)} data items failed: {e!r}, retrying.')
+                await asyncio.sleep(1)
+                self._waiting.set()
+
+    async def ingest(self, read):
+        """Drain one source, calling it again whenever it finishes, like the sync loop does with read()."""
+        while True:
+            async for data in read():
+                if data:
+                    self.buffer.append(data)
+                    if len(self.buffer) == 1:
+                        self._waiting.set()
+                    if len(self.buffer) >= self.size:
+                        self._full.set()
+            await asyncio.sleep(0)  # a source that returns right away must not starve the others
+
+    async def taskbacks(self):
+        """Blocking XREADGROUP on taskback, delivered in batches and acked with one XACK per batch."""
+        key = self.ledger.stream_key('taskback')
+        while True:
+            resp = await self.db.xreadgroup(self.ledger.group_name, self.ledger.consumer_name, {key: '>'},
+                                            count=self.taskback_count, block=1000)
+            if not resp:
+                await self.signal('loop_done')  # quiet for a second, lets the manager check on its workers
+                continue
+
+            messages = [self.ledger.message(key, i, data) for i, data in resp[0][1]]
+            for m in messages:
+                r = self.collector.taskback(m)
+                if inspect.isawaitable(r):
+                    await r
+            await self.db.xack(key, self.ledger.group_name, *[m.message_id for m in messages])
+            if self.metrics:
+                [self.metrics.since('taskback_ms', m.message_id) for m in messages]
+
+    async def run(self):
+        self.db = connect(self.service.redis_url)
+        self._waiting, self._full = asyncio.Event(), asyncio.Event()
+        sources = self.collector.sources() if hasattr(self.collector, 'sources') else [self.collector.read]
+        try:
+            await asyncio.gather(self.flusher(), self.taskbacks(), *[self.ingest(i) for i in sources])
+        finally:
+            await self.flush()
+            await self.db.aclose()
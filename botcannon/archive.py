@@ -0,0 +1,138 @@
+import json
+import mmap
+import struct
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+from walrus.streams import Message, datetime_to_id
+
+from .codec import decode
+
+# record header: message id as (ms, seq), then the length of the json payload that follows
+HEADER = struct.Struct('<QQI')
+SPANS = {'hour': 3600 * 1000, 'day': 86400 * 1000}
+
+
+def parse_id(message_id):
+    ms, seq = (message_id.decode() if isinstance(message_id, bytes) else message_id).split('-')
+    return int(ms), int(seq)
+
+
+class StreamArchive:
+    """
+    Append-only segment files holding entries moved out of a stream, one file per hour (or day):
+
+        {path}/{namespace}/{service}/{channel}/YYYY-MM-DD/HH.seg    (partition: hour)
+        {path}/{namespace}/{service}/{channel}/YYYY-MM-DD.seg       (partition: day)
+
+    Each record is HEADER followed by the message data as json, segments are read through mmap.
+    Partitions are in UTC.
+    """
+    def __init__(self, ledger, channel='data', path='./archive', partition='hour'):
+        if partition not in SPANS:
+            print(f'archive partition must be one of {list(SPANS)}, not "{partition}"')
+            exit(1)
+        self.ledger = ledger
+        self.channel = channel
+        self.key = ledger.stream_key(channel)
+        self.partition = partition
+        self.root = Path(path) / ledger.s.conf.name / ledger.service_name / channel
+        self._last_file = self.root / '.last'  # last archived id, so a crash before trimming can't duplicate
+
+    def _segment(self, ms):
+        start = datetime.fromtimestamp(ms / 1000, timezone.utc)
+        if self.partition == 'hour':
+            return self.root / f'{start:%Y-%m-%d}' / f'{start:%H}.seg'
+        return self.root / f'{start:%Y-%m-%d}.seg'
+
+    def _segment_start(self, seg: Path):
+        if self.partition == 'hour':
+            start = datetime.strptime(f'{seg.parent.name} {seg.stem}', '%Y-%m-%d %H')
+        else:
+            start = datetime.strptime(seg.stem, '%Y-%m-%d')
+        return int(start.replace(tzinfo=timezone.utc).timestamp() * 1000)
+
+    def segments(self, begin_ms=0, end_ms=None):
+        """Segment files overlapping [begin_ms, end_ms], oldest first."""
+        if not self.root.exists():
+            return []
+        span = SPANS[self.partition]
+        segs = []
+        for seg in self.root.rglob('*.seg'):
+            start = self._segment_start(seg)
+            if start + span > begin_ms and (end_ms is None or start <= end_ms):
+                segs.append((start, seg))
+        return [i[1] for i in sorted(segs)]
+
+    def last_id(self):
+        return self._last_file.read_text().strip() if self._last_file.exists() else None
+
+    def archive(self, limit=None, **older_than):
+        """
+        Move entries older than `older_than` (timedelta kwargs) from the stream into segment files, then
+        XTRIM them away. Entries some consumer group hasn't acked yet stay in the stream.
+        At most `limit` entries are moved per call, the rest on later calls.
+        Returns the number of entries archived.
+        """
+        cutoff = parse_id(datetime_to_id(datetime.now() - timedelta(**older_than)))
+        floor = self.ledger._acked_floor(self.key)
+        if floor:
+            cutoff = min(cutoff, parse_id(floor))
+        cutoff_id = f'{cutoff[0]}-{cutoff[1]}'
+
+        db = self.ledger.s.db
+        last = self.last_id()
+        start = f'({last}' if last else '-'
+        archived = 0
+        files = {}
+        try:
+            while True:
+                count = min(1000, limit - archived) if limit else 1000
+                if not count:
+                    break
+                page = db.xrange(self.key, min=start, max=f'({cutoff_id}', count=count)
+                if not page:
+                    break
+                for message_id, data in page:
+                    ms, seq = parse_id(message_id)
+                    payload = json.dumps(decode(data), default=str).encode()
+                    seg = self._segment(ms)
+                    if seg not in files:
+                        seg.parent.mkdir(parents=True, exist_ok=True)
+                        files[seg] = seg.open('ab')
+                    files[seg].write(HEADER.pack(ms, seq, len(payload)) + payload)
+                archived += len(page)
+                last = page[-1][0].decode()
+                start = f'({last}'
+        finally:
+            for f in files.values():
+                f.flush()
+                f.close()
+
+        if archived:
+            self._last_file.write_text(last)
+            ms, seq = parse_id(last)
+            db.xtrim(self.key, minid=f'{ms}-{seq + 1}', approximate=False)
+        return archived
+
+    def range(self, begin: datetime = None, end: datetime = None):
+        """Archived Messages with begin <= timestamp <= end, oldest first."""
+        begin_ms = parse_id(datetime_to_id(begin))[0] if begin else 0
+        end_ms = parse_id(datetime_to_id(end))[0] if end else None
+
+        for seg in self.segments(begin_ms, end_ms):
+            with seg.open('rb') as f:
+                size = seg.stat().st_size
+                if not size:
+                    continue
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                    offset = 0
+                    while offset + HEADER.size <= size:
+                        ms, seq, length = HEADER.unpack_from(m, offset)
+                        offset += HEADER.size
+                        if offset + length > size:
+                            break  # a record still being written
+                        if ms >= begin_ms and (end_ms is None or ms <= end_ms):
+                            data = json.loads(m[offset:offset + length])
+                            yield Message(self.key, f'{ms}-{seq}'.encode(), data)
+                        offset += length
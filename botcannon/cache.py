@@ -0,0 +1,105 @@
+import hashlib
+import json
+from collections import OrderedDict
+from time import time
+
+MISSING = object()
+
+
+class ResultCache:
+    """
+    Results of one task memoized on some of its message's fields, in an in-process LRU in front of a
+    redis tier every worker of the service shares:
+
+        {namespace}|cache:{service}:{task}:{digest}   json of the task's result, expires after ttl
+        {namespace}|cache:{service}:{task}:stats      hash of local, shared and miss counts
+
+    :param key: message fields (or result keys of earlier tasks) the result depends on, in order
+    :param ttl: seconds a result is good for, 0 = forever
+    :param max_entries: size of the in-process LRU, 0 to only use the shared tier
+    :param shared: also keep results in redis
+    """
+    def __init__(self, ledger, task, key, ttl=3600, max_entries=1024, shared=True):
+        if not key:
+            print(f'Cache of task "{task}" needs a "key" list of message fields.')
+            exit(1)
+        self.db = ledger.s.db
+        self.task = task
+        self.fields = [key] if isinstance(key, str) else list(key)
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.shared = shared
+        self.prefix = f'{ledger.s.conf.name}|cache:{ledger.service_name}:{task}'
+
+        self.lru = OrderedDict()  # digest: (expires, result)
+        self.hits = {'local': 0, 'shared': 0, 'miss': 0}  # not counted in redis yet
+        self._counted = time()
+
+    def digest(self, message, results: dict):
+        values = [message.data.get(i, results.get(i)) for i in self.fields]
+        return hashlib.sha1(json.dumps(values, default=str).encode()).hexdigest()
+
+    def _remember(self, digest, result):
+        if not self.max_entries:
+            return
+        self.lru[digest] = (time() + self.ttl if self.ttl else 0, result)
+        self.lru.move_to_end(digest)
+        while len(self.lru) > self.max_entries:
+            self.lru.popitem(last=False)
+
+    def _count(self, pipe):
+        for counter in self.hits:
+            if self.hits[counter]:
+                pipe.hincrby(f'{self.prefix}:stats', counter, self.hits[counter])
+        self.hits = {'local': 0, 'shared': 0, 'miss': 0}
+        self._counted = time()
+
+    def get_many(self, digests: list):
+        """[result or MISSING] for each digest, from the LRU or else one MGET of the shared tier."""
+        found = []
+        for d in digests:
+            hit = self.lru.get(d)
+            if hit and (not hit[0] or hit[0] > time()):
+                self.lru.move_to_end(d)
+                found.append(hit[1])
+                self.hits['local'] += 1
+            else:
+                self.lru.pop(d, None)
+                found.append(MISSING)
+
+        missing = [i for i, r in enumerate(found) if r is MISSING]
+        pipe = self.db.pipeline(transaction=False)
+        if missing and self.shared:
+            pipe.mget([f'{self.prefix}:{digests[i]}' for i in missing])
+        if len(pipe) or time() - self._counted > 10:  # counts ride along, an all-local lookup stays local
+            self._count(pipe)
+        resp = pipe.execute() if len(pipe) else []
+
+        if missing and self.shared:
+            for i, raw in zip(missing, resp[0]):
+                if raw is not None:
+                    found[i] = json.loads(raw)
+                    self._remember(digests[i], found[i])
+                    self.hits['shared'] += 1
+        self.hits['miss'] += sum(1 for i in missing if found[i] is MISSING)
+        return found
+
+    def set_many(self, items: dict):
+        """Keep {digest: result} in both tiers, results json can't hold (e.g. bytes) aren't cached."""
+        pipe = self.db.pipeline(transaction=False)
+        for d, result in items.items():
+            try:
+                raw = json.dumps(result)
+            except (TypeError, ValueError):
+                continue
+            self._remember(d, result)
+            if self.shared:
+                pipe.set(f'{self.prefix}:{d}', raw, ex=int(self.ttl) or None)
+        self._count(pipe)
+        pipe.execute() if len(pipe) else None
+
+    def stats(self):
+        """{'local': hits, 'shared': hits, 'miss': misses} counted by every worker."""
+        stats = {'local': 0, 'shared': 0, 'miss': 0}
+        stats.update({k.decode(): int(v) for k, v in self.db.hgetall(f'{self.prefix}:stats').items()})
+        return stats
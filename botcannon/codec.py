@@ -0,0 +1,64 @@
+import importlib
+
+# fields an encoded entry is stored under, by what it holds
+PACKED, ZSTD, LZ4 = b'_m', b'_z', b'_l'
+
+
+def _require(module):
+    try:
+        return importlib.import_module(module)
+    except ImportError:
+        print(f'The "{module}" module is needed by a channel codec, pip install -r requirements-codecs.txt')
+        exit(1)
+
+
+class Codec:
+    """
+    How a channel's entries are stored.
+
+        plain     redis' own flat field: value strings, as collectors have always written them
+        msgpack   the whole entry packed into one `_m` field, values can be numbers, bytes, lists or dicts
+
+    With `compress` (zstd or lz4) a packed entry larger than `threshold` bytes is compressed into `_z`/`_l`.
+    decode() goes by the fields an entry holds, so a channel can change codecs and still read older entries.
+    """
+    formats = ['plain', 'msgpack']
+    compressors = ['zstd', 'lz4']
+
+    def __init__(self, format='plain', compress=None, threshold=1024, level=3):
+        if format not in self.formats or (compress and compress not in self.compressors):
+            print(f'Codec format must be one of {self.formats} and compress one of {self.compressors}, '
+                  f'not "{format}", "{compress}"')
+            exit(1)
+        self.format = format
+        self.compress = compress if format == 'msgpack' else None
+        self.threshold = threshold
+        self.level = level
+
+        self._msgpack = _require('msgpack') if format == 'msgpack' else None
+        self._zstd = _require('zstandard').ZstdCompressor(level=level) if self.compress == 'zstd' else None
+        self._lz4 = _require('lz4.frame') if self.compress == 'lz4' else None
+
+    def encode(self, data: dict) -> dict:
+        if self.format == 'plain':
+            return data
+        packed = self._msgpack.packb(data, use_bin_type=True)
+        if self.compress and len(packed) > self.threshold:
+            if self._zstd:
+                return {ZSTD: self._zstd.compress(packed)}
+            return {LZ4: self._lz4.compress(packed, compression_level=self.level)}
+        return {PACKED: packed}
+
+
+def decode(fields: dict) -> dict:
+    """A stream entry's fields as they came from redis (bytes) to the dict that was written."""
+    if len(fields) == 1:
+        if PACKED in fields:
+            return _require('msgpack').unpackb(fields[PACKED], raw=False)
+        if ZSTD in fields:
+            return _require('msgpack').unpackb(_require('zstandard').ZstdDecompressor().decompress(fields[ZSTD]),
+                                               raw=False)
+        if LZ4 in fields:
+            return _require('msgpack').unpackb(_require('lz4.frame').decompress(fields[LZ4]), raw=False)
+    return {k.decode() if isinstance(k, bytes) else k: v.decode() if isinstance(v, bytes) else v
+            for k, v in fields.items()}
@@ -1,3 +1,6 @@
+import os
+import pickle
+import threading
 from datetime import datetime
 
 from walrus import Model
@@ -22,13 +25,99 @@ class ConfigManager:
             item.__database__ = db
             item.__namespace__ = namespace
 
-        self.service = ServiceManager(services)
-        self.params = ParameterManager(params)
+        self.db = db
+        self.version_key = f'{namespace}|config:version'
+        self.channel = f'{namespace}|config'  # pubsub, announces every new version
+
+        self.service = ServiceManager(services, self.bump)
+        self.params = ParameterManager(params, self.bump)
+
+    def snapshot_key(self, service_name):
+        return f'{self.name}|config:snapshot:{service_name}'
+
+    def snapshot(self, service_name):
+        """
+        Resolved config of a service, {'version', 'service': {fields}, 'params': {key: {k: v}}}, or None.
+        Served from this process' cache while the config version hasn't moved: one GET of the version, none
+        while watch() follows the change announcements. A snapshot built at an older version is rebuilt.
+        """
+        key = (self.name, service_name)
+        cached = _snapshots.get(key)
+        version = _versions.get((self.name, os.getpid()))
+        if cached and version is None:
+            version = int(self.db.get(self.version_key) or 0)
+        if cached and cached['version'] == version:
+            return cached
+
+        pipe = self.db.pipeline(transaction=False)
+        pipe.get(self.version_key)
+        pipe.get(self.snapshot_key(service_name))
+        version, raw = pipe.execute()
+        version = int(version or 0)
+        snapshot = pickle.loads(raw) if raw else None
+        if not snapshot or snapshot['version'] != version:
+            snapshot = self.publish(service_name, version)
+        if snapshot:
+            _snapshots[key] = snapshot
+        return snapshot
+
+    def publish(self, service_name, version=None):
+        """Build a service's snapshot from its models and store it for every process, None if no such service."""
+        version = int(self.db.get(self.version_key) or 0) if version is None else version
+        service = self.service.get(service_name)
+        if not service:
+            return None
+
+        fields = {i: getattr(service, i) for i in ['name'] + Services._keys}
+        keys = [fields['c_conf'], fields['s_conf']] + [t['conf']['key'] for t in (fields['tasks'] or {}).values()]
+        pipe = self.db.pipeline(transaction=False)
+        for i in keys:
+            pipe.exists(Params._query.get_primary_hash_key(i))  # an entry can exist without any data yet
+            pipe.hgetall(Params(name=i).data.key)
+        resp = pipe.execute()
+        params = {i: {k.decode(): v.decode() for k, v in data.items()}
+                  for i, exists, data in zip(keys, resp[::2], resp[1::2]) if exists}
+
+        # built at `version`: a change made meanwhile bumps past it and the snapshot is rebuilt when next used
+        snapshot = {'version': version, 'service': fields, 'params': params}
+        self.db.set(self.snapshot_key(service_name), pickle.dumps(snapshot))
+        return snapshot
+
+    def bump(self):
+        """Mark the config as changed, cached snapshots are rebuilt when next used."""
+        version = self.db.incr(self.version_key)
+        self.db.publish(self.channel, version)
+        return version
+
+    def watch(self):
+        """
+        Follow version announcements in a thread, so this process uses its cached snapshots without asking
+        redis. For long-lived processes that init services over and over.
+        """
+        key = (self.name, os.getpid())
+        if key in _versions:
+            return
+        pubsub = self.db.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(self.channel)
+        _versions[key] = int(self.db.get(self.version_key) or 0)  # after subscribing, so nothing is missed
+
+        def listen():
+            try:
+                for m in pubsub.listen():
+                    _versions[key] = int(m['data'])
+            finally:
+                _versions.pop(key, None)  # back to asking for the version
+
+        threading.Thread(target=listen, daemon=True, name='config-watch').start()
+
+
+_snapshots = {}  # (namespace, service name): snapshot, kept across forks so workers start with it
+_versions = {}  # (namespace, pid): version last announced, while watch() is following
 
 
 class Services(Model):
     name = TextField(primary_key=True)
-    _keys = ['shell', 's_entry', 's_conf', 'collector', 'c_entry', 'c_conf', 'tasks']
+    _keys = ['shell', 's_entry', 's_conf', 'collector', 'c_entry', 'c_conf', 'tasks', 'options']
 
     collector = TextField()
     c_entry = TextField()
@@ -39,6 +128,7 @@ class Services(Model):
     s_conf = TextField()
 
     tasks = PickledField()
+    options = PickledField()  # {'workers': {'mode': 'pool', ...}, ...}
 
 
 class Params(Model):
@@ -46,9 +136,30 @@ class Params(Model):
     data = HashField()  # {'key': 'value, 'api_key': KEY}
 
 
+class ServiceSnapshot:
+    """A service's snapshot, read like its Services model."""
+    _keys = Services._keys
+
+    def __init__(self, snapshot: dict):
+        self.version = snapshot['version']
+        self._data = snapshot['service']
+        self._params = snapshot['params']
+
+    def __getattr__(self, name):
+        try:
+            return self.__dict__['_data'][name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def params(self, key):
+        """{name: value} of a params entry, None if there is none."""
+        return self._params.get(key)
+
+
 class BaseFunctions:
-    def __init__(self, model: Model):
+    def __init__(self, model: Model, changed=None):
         self._model = model
+        self._changed = changed or (lambda: None)  # called after every write
 
     def all(self):
         return self._model.all()
@@ -60,12 +171,15 @@ class BaseFunctions:
             return None
 
     def add(self, name):
-        return self._model.create(name=name)
+        item = self._model.create(name=name)
+        self._changed()
+        return item
 
     def rm(self, name):
         item = self.get(name)
         if item:
             self._model.delete(item)
+            self._changed()
             print('Item removed')
         else:
             print('Item doesnt exist')
@@ -73,8 +187,8 @@ class BaseFunctions:
 
 class ServiceManager(BaseFunctions):
 
-    def __init__(self, services: type(Services)):
-        super().__init__(services)
+    def __init__(self, services: type(Services), changed=None):
+        super().__init__(services, changed)
 
     def define(self, service_name, shell, s_entry, s_conf, collector, c_entry, c_conf):
         service = self.get(service_name)
@@ -84,12 +198,13 @@ class ServiceManager(BaseFunctions):
         service.shell, service.s_entry, service.s_conf = shell, s_entry, s_conf
         service.collector, service.c_entry, service.c_conf = collector, c_entry, c_conf
         service.save()
+        self._changed()
         return service
 
 
 class ParameterManager(BaseFunctions):
-    def __init__(self, configs: type(Params)):
-        super().__init__(configs)
+    def __init__(self, configs: type(Params), changed=None):
+        super().__init__(configs, changed)
 
     def kv(self, name, **kwargs):
         conf = self.get(name)
@@ -98,6 +213,7 @@ class ParameterManager(BaseFunctions):
                 return f'No args!'
             for k in kwargs:
                 conf.data[k] = kwargs[k]
+            self._changed()
             return f'OK'
         else:
             return f'Key missing! Try: add {name}'
@@ -106,6 +222,7 @@ class ParameterManager(BaseFunctions):
         conf = self.get(name)
         if conf:
             del conf.data[key]
+            self._changed()
             return 'Deleted.'
         else:
             return 'Create this service first.'
@@ -128,5 +245,6 @@ class ParameterManager(BaseFunctions):
                 pswd = getpass.getpass(f'{name}->{k} :')
                 conf.data[k] = pswd
                 print(f'OK\n')
+            self._changed()
         else:
             return f'Key missing! Try `add {name}`'
@@ -0,0 +1,150 @@
+import json
+import math
+import threading
+from datetime import datetime, timedelta
+from time import time
+
+from walrus.streams import datetime_to_id
+
+from . import transport
+from .archive import parse_id
+from .codec import decode
+
+# bucket i holds values in (BASE ** (i - 1), BASE ** i] ms, so a percentile is off by at most ~5%
+BASE = 1.1
+LOG_BASE = math.log(BASE)
+
+
+def id_ms(message_id):
+    """Milliseconds since epoch a stream id was made at."""
+    return parse_id(message_id)[0]
+
+
+class Histogram:
+    """Log-bucketed histogram of millisecond timings, cheap to record into and to merge."""
+    def __init__(self):
+        self.buckets = {}
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def record(self, ms):
+        i = math.ceil(math.log(ms) / LOG_BASE) if ms > 0.01 else -49  # everything below 10µs in one bucket
+        self.buckets[i] = self.buckets.get(i, 0) + 1
+        self.count += 1
+        self.sum += ms
+        self.max = max(self.max, ms)
+
+    def merge(self, other: 'Histogram'):
+        for i in other.buckets:
+            self.buckets[i] = self.buckets.get(i, 0) + other.buckets[i]
+        self.count += other.count
+        self.sum += other.sum
+        self.max = max(self.max, other.max)
+
+    def percentile(self, p):
+        """Middle of the bucket the p-th percentile (0-100) falls in, capped at the max seen."""
+        if not self.count:
+            return 0.0
+        rank = p / 100 * self.count
+        seen = 0
+        for i in sorted(self.buckets):
+            seen += self.buckets[i]
+            if seen >= rank:
+                return min(BASE ** (i - 0.5), self.max)
+        return self.max
+
+    def to_fields(self):
+        return {'count': self.count, 'sum': f'{self.sum:.3f}', 'max': f'{self.max:.3f}',
+                'buckets': json.dumps(self.buckets)}
+
+    @classmethod
+    def from_fields(cls, data: dict):
+        h = cls()
+        h.buckets = {int(i): n for i, n in json.loads(data['buckets']).items()}
+        h.count = int(data['count'])
+        h.sum = float(data['sum'])
+        h.max = float(data['max'])
+        return h
+
+
+class Metrics:
+    """
+    Timings aggregated in-process into a Histogram per (metric, task) and written to the service's `log`
+    stream every `flush_s` seconds, one entry per histogram. Safe to record into from any thread.
+    The connections in use in the process' redis pool are sampled every second as `pool_in_use`.
+
+        metric  task  source  span_s  count  sum  max  buckets
+    """
+    def __init__(self, ledger, source, flush_s=10.0):
+        self.ledger = ledger
+        self.source = source  # the process that recorded, e.g. its consumer name
+        self.flush_s = flush_s
+        self.histograms = {}
+        self._started = time()
+        self._lock = threading.Lock()
+        self._closed = threading.Event()
+        self._thread = threading.Thread(target=self._flusher, daemon=True)
+        self._thread.start()
+
+    def record(self, metric, ms, task=''):
+        with self._lock:
+            h = self.histograms.get((metric, task))
+            if h is None:
+                h = self.histograms[(metric, task)] = Histogram()
+            h.record(ms)
+
+    def since(self, metric, message_id, task=''):
+        """Record the time since a stream id was made, e.g. how long a message waited to be picked up."""
+        self.record(metric, time() * 1000 - id_ms(message_id), task)
+
+    def flush(self):
+        with self._lock:
+            histograms, self.histograms = self.histograms, {}
+            started, self._started = self._started, time()
+        if histograms:
+            span = f'{time() - started:.3f}'
+            self.ledger.write_many('log', [{'metric': metric, 'task': task, 'source': self.source, 'span_s': span,
+                                            **h.to_fields()} for (metric, task), h in histograms.items()])
+        return len(histograms)
+
+    def close(self):
+        self._closed.set()
+        return self.flush()
+
+    def _flusher(self):
+        flushed = time()
+        while not self._closed.wait(1):
+            self.record('pool_in_use', transport.pool_stats()['in_use'])
+            if time() - flushed >= self.flush_s:
+                flushed = time()
+                self.flush()
+
+
+def summarize(ledger, **since):
+    """
+    Histograms in the `log` stream over the last `since` (timedelta kwargs), merged per (metric, task),
+    and the messages/s taken by the workers over that time.
+    """
+    begin = datetime.now() - timedelta(**since)
+    start = datetime_to_id(begin)
+    merged = {}
+    first = None
+    key = ledger.stream_key('log')
+    while True:
+        page = ledger.s.db.xrange(key, min=start, max='+', count=1000)
+        if not page:
+            break
+        for message_id, data in page:
+            data = decode(data)
+            if 'metric' not in data:
+                continue  # something else logged
+            if first is None:
+                first = id_ms(message_id) - float(data['span_s']) * 1000
+            h = merged.setdefault((data['metric'], data['task']), Histogram())
+            h.merge(Histogram.from_fields(data))
+        start = f'({page[-1][0].decode()}'
+
+    messages = sum(h.count for (metric, _), h in merged.items() if metric == 'queue_ms')
+    seconds = time() - max(first / 1000, begin.timestamp()) if first else 0
+    return merged, messages / seconds if seconds > 0 else 0.0
@@ -1,3 +1,4 @@
+import threading
 import typing
 
 from walrus.streams import Message
@@ -13,3 +14,52 @@ class Collector:
     def taskback(self, message: Message) -> None:
         pass
 
+
+class AsyncCollector:
+    """
+    Collector for `up`'s event loop mode, picked when read() is an async generator. read() is called
+    again whenever it finishes. taskback() may be sync or async.
+    """
+    async def read(self) -> typing.AsyncGenerator[dict, None]:
+        for _ in ():
+            yield {}
+
+    def sources(self) -> typing.List[typing.Callable[[], typing.AsyncGenerator[dict, None]]]:
+        """Async generator functions to run side by side in one collector process, default just read."""
+        return [self.read]
+
+    async def taskback(self, message: Message) -> None:
+        pass
+
+
+class Shell:
+    # lifecycle modes this shell is safe under, see botcannon.multiprocess.ShellPool. the first is used when
+    # the service yml doesn't pick one. shells not declaring any default to 'per_message' and allow them all.
+    lifecycles = ('per_message', 'pooled', 'singleton')
+
+    def close(self) -> None:
+        """Optional, called when the worker is done with a reused instance."""
+        pass
+
+
+class Task:
+    # with a `timeout` in the task's yml spec, set by the worker when a call runs past it. poll it in long
+    # loops and return early, the worker has already given up on the call.
+    cancelled: threading.Event = None
+
+    def task(self, message: Message, **kwargs) -> dict:
+        pass
+
+    def task_batch(self, messages: typing.List[Message], results_list: typing.List[dict]) -> typing.List[dict]:
+        """
+        Optional, handle every message of a read in one call. `results_list[i]` holds the results so far
+        for `messages[i]`, return a list of result dicts (or None) in the same order.
+        Tasks without it are called once per message with `task()`.
+        """
+        pass
+
+
+def batch_capable(task) -> bool:
+    """True if the task's class implements its own task_batch."""
+    impl = getattr(type(task), 'task_batch', None)
+    return callable(impl) and impl is not Task.task_batch
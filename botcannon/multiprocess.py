@@ -1,17 +1,196 @@
 import multiprocessing as mp
+import queue
+import math
+from time import time, sleep
 from botcannon import BotCannon
+from botcannon.models import batch_capable
+from botcannon.cache import ResultCache, MISSING
 import signal
 import datetime
+import os
+import socket
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from uuid import uuid4
+
+import psutil
+
 
 def init_worker():
     signal.signal(signal.SIGINT, signal.SIG_IGN)
 
 
+class TaskTimeout(Exception):
+    pass
+
+
+def plan_tasks(specs: dict):
+    """
+    Task names grouped into levels whose tasks can run side by side, yml order within a level.
+    `depends_on` lists task names, or result keys another task declares in `produces`.
+    Without any `depends_on` every task depends on the one before it, as tasks always ran in yml order.
+    """
+    names = list(specs)
+    if not any('depends_on' in specs[i] for i in names):
+        return [[i] for i in names]
+
+    producers = {k: n for n in names for k in specs[n].get('produces', [])}
+    deps = {}
+    for n in names:
+        deps[n] = set()
+        depends_on = specs[n].get('depends_on', [])
+        for d in [depends_on] if isinstance(depends_on, str) else depends_on:
+            if d in specs:
+                deps[n].add(d)
+            elif d in producers:
+                deps[n].add(producers[d])
+            else:
+                print(f'Task "{n}" depends on "{d}", which is neither a task nor a key a task produces.')
+                exit(1)
+
+    levels, done = [], set()
+    while len(done) < len(names):
+        level = [n for n in names if n not in done and deps[n] <= done]
+        if not level:
+            print(f'Task dependencies have a cycle: {[n for n in names if n not in done]}')
+            exit(1)
+        levels.append(level)
+        done.update(level)
+    return levels
+
+
+def fair_shares(budget, wants: dict, weights: dict):
+    """
+    {name: workers} dealing `budget` workers out one at a time to whichever service still wanting more has
+    the fewest per unit of weight, so no service gets more than it wants and a busy one can't starve the rest.
+    """
+    shares = {i: 0 for i in wants}
+    for _ in range(budget):
+        hungry = [i for i in wants if shares[i] < wants[i]]
+        if not hungry:
+            break
+        shares[min(hungry, key=lambda i: shares[i] / weights[i])] += 1
+    return shares
+
+
+class ServiceWorkers:
+    """
+    What running a service's workers takes besides a manager loop: its rollup process, housekeeping and
+    the WorkerPool and LagScaler made from its `workers` options. Shared by ManageWorkers and Supervisor.
+    """
+    def __init__(self, service, options=None, partitions=None):
+        self.service = service
+        self.service_name = service.ledger.service_name
+        self.options = options or {}  # 'workers' section of the service yml
+        self.partitions = partitions  # data partitions this host's workers read, None = all
+        self.rollups = None  # RollupWorker, if the service has rollups
+        self._rolled = 0.0  # when it was last started
+
+    def start_rollups(self):
+        """RollupWorker for the service, if it has rollups."""
+        if not self.service.rollups:
+            return None
+        self.rollups = RollupWorker(self.service_name)
+        self.rollups.daemon = True
+        self.rollups.start()
+        self._rolled = time()
+        return self.rollups
+
+    def keep_rollups(self):
+        """Replace a RollupWorker that died, at most every 10s. Called from the manager loop."""
+        if self.rollups and not self.rollups.is_alive() and time() - self._rolled > 10:
+            print(f'[!] Rollups of {self.service_name} exited ({self.rollups.exitcode}), restarting.')
+            self.rollups.join()
+            self.start_rollups()
+
+    def stop_rollups(self):
+        if self.rollups:
+            self.rollups.terminate()
+
+    def worker_kwargs(self):
+        o = self.options
+        return {
+            'reclaim_idle_ms': int(o.get('reclaim_idle_ms', 60000)),
+            'reclaim_interval': float(o.get('reclaim_interval', 30)),
+        }
+
+    def host_partitions(self):
+        """Data partitions served by this host, all of them unless `up` was given a list."""
+        count = self.service.ledger.partitions
+        if self.partitions is None:
+            return list(range(count))
+        wrong = [i for i in self.partitions if not 0 <= int(i) < count]
+        if wrong:
+            print(f'Partitions {wrong} out of range, the service has {count}.')
+            exit(1)
+        return [int(i) for i in self.partitions]
+
+    def start_housekeeping(self):
+        """Run housekeeping every `housekeeping_s` on a thread of its own, so it never holds up the manager loop."""
+        interval = float(self.options.get('housekeeping_s', 30))
+
+        def loop():
+            while True:
+                sleep(interval)
+                try:
+                    self.housekeeping()
+                except Exception as e:
+                    print(f'[!] Housekeeping of {self.service_name} failed: {e!r}')
+
+        threading.Thread(target=loop, daemon=True, name=f'housekeeping-{self.service_name}').start()
+
+    def housekeeping(self):
+        """Upkeep of the service's streams, see start_housekeeping."""
+        ledger = self.service.ledger
+        for i in self.host_partitions():
+            channel = ledger.data_channels[i]
+            # archive before the acked trim below, which would otherwise drop entries that are due.
+            # age and maxlen policies trim on every write, a service refuses an age shorter than `after`
+            archive = self.service.archive_of(channel)
+            if archive:
+                conf = self.service.options['archive']
+                archived = archive.archive(int(conf.get('max_entries', 100000)), **conf.get('after', {'days': 7}))
+                if archived:
+                    print(f'[A] Archived {archived} entries to {archive.root}')
+
+            reaped = ledger.reap_consumers(channel, int(self.options.get('consumer_idle_ms', 300000)))
+            if reaped:
+                print(f'[C] Removed {len(reaped)} idle consumers of {channel}: {", ".join(reaped)}')
+
+        reclaimed = self.service.ledger.trim()
+        if reclaimed:
+            print(f'[T] Trimmed ' + ', '.join(f'{i}: {reclaimed[i] / 1024:.0f}KB' for i in reclaimed))
+
+    def make_pool(self, size):
+        o = self.options
+        return WorkerPool(self.service_name,
+                          size=size,
+                          wait_ms=int(o.get('block_ms', 1000)),
+                          msg_count=int(o.get('count', 1)),
+                          max_messages=int(o.get('recycle_messages', 0)),
+                          max_rss_mb=int(o.get('recycle_mb', 0)),
+                          partitions=self.host_partitions() if self.service.ledger.partitions > 1 else None,
+                          **self.worker_kwargs())
+
+    def make_scaler(self, pool, minimum, maximum):
+        o = self.options
+        return LagScaler(self.service.ledger, pool,
+                         minimum=minimum,
+                         maximum=maximum,
+                         interval=float(o.get('scale_interval', 5)),
+                         drain_s=float(o.get('drain_s', 10)),
+                         down_ticks=int(o.get('scale_down_ticks', 3)))
+
+
 class ManageWorkers(mp.Process):
-    def __init__(self, service_name, q, cooldown):
+    def __init__(self, service_name, q, cooldown, options=None, partitions=None):
         self._service_name = service_name
         self.q = q
         self.cooldown = cooldown
+        self.options = options or {}  # 'workers' section of the service yml
+        self.partitions = partitions  # data partitions this host's workers read, None = all
+        self.workers = None  # ServiceWorkers, made in the process
 
         super().__init__()
         self.start()
@@ -19,23 +198,43 @@ class ManageWorkers(mp.Process):
     def run(self) -> None:
         print(f'Starting {mp.current_process().name} loop.')
         init_worker()
+        self.workers = ServiceWorkers(BotCannon().init(self._service_name), self.options, self.partitions)
 
+        self.workers.start_rollups()
+        self.workers.start_housekeeping()
+
+        if self.options.get('mode') == 'pool':
+            self._run_pool()
+        else:
+            self._run_spawn()
+
+        self.workers.stop_rollups()
+        print(f'Exiting {mp.current_process().name}')
+
+    def _run_spawn(self):
+        """One worker process per 'hot' message, plus an 'idle' worker when nothing is alive."""
         ps = []
         h = 0
         l_time = datetime.datetime.now()
         for d in iter(self.q.get, None):
+            n = 1
+            if isinstance(d, tuple):  # ('hot', messages in the flush)
+                d, n = d
+
             if d == 'killjobs':
                 print(f'[!] Poison pill, terminating {mp.current_process().name}.')
                 [i.terminate() for i in ps]
 
             elif d == 'hot':
                 h += 1
-                ps.append(TaskWorker(self._service_name, 1000, 1))
+                ps.append(TaskWorker(self._service_name, 1000, n, partitions=self.partitions,
+                                     **self.workers.worker_kwargs()))
                 ps[-1].daemon = True
                 ps[-1].start()
 
             elif d == 'idle':
-                ps.append(TaskWorker(self._service_name, 30000, 1))
+                ps.append(TaskWorker(self._service_name, 30000, 1, partitions=self.partitions,
+                                     **self.workers.worker_kwargs()))
                 ps[-1].daemon = True
                 ps[-1].start()
 
@@ -49,6 +248,8 @@ class ManageWorkers(mp.Process):
                 if not active:
                     self.q.put('idle')
 
+            self.workers.keep_rollups()
+
             if (datetime.datetime.now() - l_time).seconds > self.cooldown:
                 l_time = datetime.datetime.now()
                 alive = [i for i in ps if i.is_alive()]
@@ -56,47 +257,721 @@ class ManageWorkers(mp.Process):
                 ps = alive
                 h = 0
 
+    def _run_pool(self):
+        """Keep a set of long-lived workers up, replacing any that recycle or die.
+        With `max` set, the pool is resized between `min` and `max` by a LagScaler."""
+        o = self.options
+        scaling = 'max' in o
+        pool = self.workers.make_pool(int(o.get('min', 1) if scaling else o.get('size', 2)))
+        pool.fill()
+
+        scaler = None
+        if scaling:
+            scaler = self.workers.make_scaler(pool, int(o.get('min', 1)), int(o['max']))
+
+        stopping = False
+        l_time = datetime.datetime.now()
+        while True:
+            try:
+                d = self.q.get(timeout=1)
+            except queue.Empty:
+                d = 'tick'  # no collector signal, still check on the pool
+
+            if isinstance(d, tuple):  # ('hot', n), the pool doesn't need the count
+                d = d[0]
+
+            if d is None:
+                break
+            elif d == 'killjobs':
+                print(f'[!] Poison pill, terminating {mp.current_process().name}.')
+                pool.terminate()
+                stopping = True
+            elif not stopping:
+                # 'hot', 'idle' and 'loop_done' all mean the same thing here: keep the pool full
+                pool.fill()
+                self.workers.keep_rollups()
+
+            if scaler and not stopping and scaler.due():
+                pool.resize(scaler.tick())
+
+            if (datetime.datetime.now() - l_time).seconds > self.cooldown:
+                l_time = datetime.datetime.now()
+                print(f'[W] {len(pool.workers)}p up of {pool.size}. {pool.spawned}p spawned/{self.cooldown}s, '
+                      f'{pool.timeouts.value} timeouts.')
+                pool.spawned = 0
+
+class Supervisor(mp.Process):
+    """
+    Workers of several services under one manager and a budget of `budget` worker processes. Every service
+    gets a WorkerPool sized by its own LagScaler between its `min` (default 0) and `max` (default the budget),
+    and the budget is split over what they want by `weight`, see fair_shares. A 'hot' signal from an idle
+    service's collector gets it a worker right away.
+    """
+    def __init__(self, service_names, q, cooldown, budget):
+        self._service_names = service_names
+        self.q = q
+        self.cooldown = cooldown
+        self.budget = budget
+
+        super().__init__()
+        self.start()
+
+    def run(self) -> None:
+        print(f'Starting {mp.current_process().name} loop for {len(self._service_names)} services.')
+        init_worker()
+        cannon = BotCannon()
+        pools, scalers, wants, weights, services = {}, {}, {}, {}, []
+        for name in self._service_names:
+            service = cannon.init(name)
+            o = service.options.get('workers', {})
+            m = ServiceWorkers(service, o)
+            services.append(m)
+            m.start_rollups()
+            m.start_housekeeping()
+
+            wants[name] = int(o.get('min', 0))
+            weights[name] = max(float(o.get('weight', 1)), 0.01)
+            pools[name] = m.make_pool(0)
+            scalers[name] = m.make_scaler(pools[name], wants[name], int(o.get('max', self.budget)))
+        self.allocate(pools, wants, weights)
+
+        stopping = False
+        l_time = datetime.datetime.now()
+        while True:
+            try:
+                d = self.q.get(timeout=1)
+            except queue.Empty:
+                d = 'tick'
+
+            if d is None:
+                break
+            elif d == 'killjobs':
+                print(f'[!] Poison pill, terminating {mp.current_process().name}.')
+                [i.terminate() for i in pools.values()]
+                stopping = True
+            if stopping:
+                continue
+
+            changed = False
+            if isinstance(d, tuple):  # (service name, signal of its collector)
+                name, sent = d
+                if isinstance(sent, tuple) and sent[0] == 'hot' and not pools[name].size:
+                    wants[name] = max(wants[name], 1)
+                    changed = True
+
+            for name in scalers:
+                if scalers[name].due():
+                    want = scalers[name].tick()
+                    changed = changed or want != wants[name]
+                    wants[name] = want
+
+            if changed:
+                self.allocate(pools, wants, weights)
+            [i.fill() for i in pools.values()]
+            [i.keep_rollups() for i in services]
+
+            if (datetime.datetime.now() - l_time).seconds > self.cooldown:
+                l_time = datetime.datetime.now()
+                print(f'[W] {sum(len(i.workers) for i in pools.values())}p up of {self.budget}. ' +
+                      ', '.join(f'{i}: {len(pools[i].workers)}p' for i in pools))
+
+        [i.stop_rollups() for i in services]
         print(f'Exiting {mp.current_process().name}')
 
+    def allocate(self, pools, wants, weights):
+        shares = fair_shares(self.budget, wants, weights)
+        resized = [i for i in pools if shares[i] != pools[i].size]
+        for i in resized:
+            pools[i].resize(shares[i])
+        if resized:
+            print(f'[B] ' + ', '.join(f'{i}: {shares[i]}p (wants {wants[i]})' for i in resized))
+
+
+class WorkerPool:
+    """
+    Long-lived TaskWorkers for one service, kept at `size`.
+
+    With `partitions`, worker slot k reads every partition p with p % size == k, so while size is at most
+    the number of partitions each partition has a single reader and keeps its order. Slots past the number
+    of partitions share partition k % len(partitions).
+    """
+    def __init__(self, service_name, size=2, wait_ms=1000, msg_count=1, partitions=None, **worker_kwargs):
+        self.service_name = service_name
+        self.size = size
+        self.wait_ms = wait_ms
+        self.msg_count = msg_count
+        self.partitions = partitions
+        self.worker_kwargs = worker_kwargs  # passed on to each TaskWorker
+
+        self.workers = []
+        self.retiring = []  # asked to stop, finishing their current read
+        self.spawned = 0
+        self.processed = mp.Value('Q', 0)  # messages handled by every worker of this pool
+        self.timeouts = mp.Value('Q', 0)  # task calls that ran past their deadline
+
+    def assigned(self, slot):
+        """Partitions read by the worker in `slot`, None for all."""
+        if not self.partitions:
+            return None
+        if slot >= len(self.partitions):
+            return [self.partitions[slot % len(self.partitions)]]
+        return [p for i, p in enumerate(self.partitions) if i % self.size == slot]
+
+    def spawn(self, slot=None):
+        slot = len(self.workers) if slot is None else slot
+        w = TaskWorker(self.service_name, self.wait_ms, self.msg_count, persistent=True,
+                       processed=self.processed, timeouts=self.timeouts, partitions=self.assigned(slot),
+                       slot=slot, **self.worker_kwargs)
+        w.daemon = True
+        w.start()
+        self.workers.append(w)
+        self.spawned += 1
+        return w
+
+    @staticmethod
+    def _alive(workers):
+        alive = []
+        for i in workers:
+            if i.is_alive():
+                alive.append(i)
+            else:
+                i.join()
+        return alive
+
+    def reap(self):
+        """Join workers that exited (recycled or crashed), returns how many were removed."""
+        alive = self._alive(self.workers)
+        reaped = len(self.workers) - len(alive)
+        self.workers = alive
+        self.retiring = self._alive(self.retiring)
+        return reaped
+
+    def fill(self):
+        self.reap()
+        taken = [i.slot for i in self.workers]
+        for slot in [i for i in range(self.size) if i not in taken]:
+            self.spawn(slot)
+
+    def resize(self, size):
+        """
+        Grow right away, shrink by letting the newest workers finish their current read and exit.
+        With partitions, workers whose partitions change at the new size are replaced the same way.
+        """
+        self.size = size
+        self.reap()
+        keep = [i for i in self.workers if i.slot < size and i.partitions == self.assigned(i.slot)]
+        extra = [i for i in self.workers if i not in keep]
+        [i.stop.set() for i in extra]
+        self.retiring.extend(extra)
+        self.workers = keep
+        self.fill()
+
+    def terminate(self):
+        [i.terminate() for i in self.workers + self.retiring]
+
+
+class LagScaler:
+    """Sizes a WorkerPool from the consumer-group backlog of the data stream and the pool's throughput.
+
+    The pool grows as soon as the backlog can't be drained within `drain_s` at the measured
+    per-worker rate, and only shrinks after `down_ticks` consecutive ticks asking for fewer workers.
+    """
+    def __init__(self, ledger, pool, minimum=1, maximum=4, interval=5.0, drain_s=10.0, down_ticks=3):
+        self.ledger = ledger
+        self.pool = pool
+        self.minimum = minimum
+        self.maximum = maximum
+        self.interval = interval
+        self.drain_s = drain_s
+        self.down_ticks = down_ticks
+
+        self.rate = 0.0  # messages/s for the whole pool over the last interval
+        self._last = time()
+        self._seen = pool.processed.value
+        self._low = 0
+
+    def due(self):
+        return time() - self._last >= self.interval
+
+    def tick(self):
+        """Returns the pool size wanted right now."""
+        now = time()
+        done = self.pool.processed.value
+        self.rate = (done - self._seen) / (now - self._last)
+        self._last, self._seen = now, done
+
+        b = self.ledger.backlog('data')
+        backlog = b['pending'] + b['lag']
+        current = self.pool.size
+        per_worker = self.rate / current if current else 0.0
+
+        if backlog and per_worker:
+            need = math.ceil(backlog / (per_worker * self.drain_s))
+        elif backlog:
+            need = current + 1  # nothing measured yet, step up
+        else:
+            need = self.minimum
+        need = max(self.minimum, min(self.maximum, need))
+
+        if need < current:
+            self._low += 1
+            if self._low < self.down_ticks:
+                return current
+        self._low = 0
+
+        if need != current:
+            print(f'[S] backlog {backlog} ({b["pending"]} pending, {b["lag"]} lag), '
+                  f'{self.rate:.1f} msg/s, {current}p -> {need}p')
+        return need
+
+
+class RollupWorker(mp.Process):
+    """Keeps the service's rollups current, see botcannon.rollup."""
+    def __init__(self, service_name):
+        super().__init__()
+        self._service_name = service_name
+
+    def run(self) -> None:
+        # terminate() ends the run between batches, so nothing read is left unacked
+        stop = threading.Event()
+        signal.signal(signal.SIGTERM, lambda *_: stop.set())
+        init_worker()
+
+        service = BotCannon().init(self._service_name)
+        conf = service.options['rollup']
+        service.rollups.create(conf.get('from', '$'))
+        service.rollups.run(count=int(conf.get('count', 500)), stop=stop)
+
+
+class ShellPool:
+    """
+    Shell instances for torch tasks, reused according to the shell's lifecycle `mode`:
+
+        singleton     one instance for the life of the worker, shared by concurrent tasks
+        pooled        an instance per concurrent call, each reused for up to `max_uses` calls (0 = no limit)
+        per_message   a new instance for every call
+
+    Reused instances are closed with their close() method, if they have one, when retired.
+    """
+    modes = ['singleton', 'pooled', 'per_message']
+
+    def __init__(self, factory, mode='per_message', max_uses=0, metrics=None):
+        if mode not in self.modes:
+            print(f'Shell lifecycle must be one of {self.modes}, not "{mode}"')
+            exit(1)
+        self.factory = factory
+        self.mode = mode
+        self.max_uses = max_uses
+        self.metrics = metrics
+
+        self.idle = []  # [[instance, uses]] of the pool
+        self.instance = None  # the singleton
+        self._lock = threading.Lock()
+
+    def _make(self):
+        started = time()
+        instance = self.factory()
+        self.metrics.record('shell_ms', (time() - started) * 1000) if self.metrics else None
+        return instance
+
+    @staticmethod
+    def _close(instance):
+        close = getattr(instance, 'close', None)
+        close() if callable(close) else None
+
+    @contextmanager
+    def shell(self):
+        if self.mode == 'per_message':
+            yield self._make()
+
+        elif self.mode == 'singleton':
+            with self._lock:
+                if self.instance is None:
+                    self.instance = self._make()
+            yield self.instance
+
+        else:
+            with self._lock:
+                held = self.idle.pop() if self.idle else None
+            held = held or [self._make(), 0]
+            try:
+                yield held[0]
+            except TaskTimeout:
+                raise  # the abandoned call still has the instance, leave it out of the pool
+            except Exception:
+                self._release(held)
+                raise
+            self._release(held)
+
+    def _release(self, held):
+        held[1] += 1
+        if self.max_uses and held[1] >= self.max_uses:
+            self._close(held[0])
+        else:
+            with self._lock:
+                self.idle.append(held)
+
+    def close(self):
+        with self._lock:
+            instances, self.idle = [i[0] for i in self.idle], []
+            if self.instance is not None:
+                instances.append(self.instance)
+                self.instance = None
+        [self._close(i) for i in instances]
+
 
 class TaskWorker(mp.Process):
-    def __init__(self, service_name, wait_ms, msg_count, recall_shell=False):
+    def __init__(self, service_name, wait_ms, msg_count, recall_shell=False,
+                 persistent=False, max_messages=0, max_rss_mb=0, processed=None,
+                 reclaim_idle_ms=60000, reclaim_interval=30.0, timeouts=None, partitions=None, slot=None):
         super().__init__()
-        self.cannon = BotCannon()
-        self.service = self.cannon.init(service_name)
+        self._service_name = service_name
         self.recall_shell = recall_shell
+        self.partitions = partitions  # data partitions to read, None = all
+        self.slot = slot  # its place in a WorkerPool
+        self.channels = []  # data channels of those partitions, see setup()
 
         self.block = wait_ms  # in ms, 0 = wait indefinitely for a message
         self.count = msg_count  # gather this many messages before returning, works best with large block
 
+        self.persistent = persistent  # keep reading until recycled instead of exiting after one read
+        self.max_messages = max_messages  # recycle after this many messages, 0 = never
+        self.max_rss_mb = max_rss_mb  # recycle once resident memory passes this, 0 = never
+        self.processed = processed  # shared counter the pool's scaler reads throughput from
+        self.stop = mp.Event()  # set by the pool to retire this worker after its current read
+
+        self.reclaim_idle_ms = reclaim_idle_ms  # take over messages other consumers held unacked this long
+        self.reclaim_interval = reclaim_interval  # seconds between XAUTOCLAIM checks
+        self._reclaimed = 0.0
+        self.max_deliveries = 3  # from the service's retry policy, see setup()
+
+        self.cannon = None
+        self.service = None
         self.tasks = []
+        self.levels = []  # [[(name, task)]], tasks of a level run concurrently, see plan_tasks
+        self.executor = None
+
+        self.task_timeouts = {}  # name: seconds, from the task specs
+        self.message_timeout = 0.0  # seconds a message may spend in its tasks, 0 = no limit
+        self.timeouts = timeouts  # shared counter of calls that ran past their deadline
+        self.hung = []  # task threads still running past their deadline, the worker recycles when any exist
+        self.hung_tasks = set()  # names of tasks one of those threads is running, not called again
+        self._started = {}  # message_id: when the current handle() took it on
+
+        self.caches = {}  # name: ResultCache, for tasks with a `cache` in their spec
+        self.results_only = False  # taskbacks carry results and the source id instead of the whole message
+        self.shells = None  # ShellPool for torch tasks
+        self.metrics = None  # see botcannon.metrics, made in setup()
+        self._created = time()  # spawn cost is measured from here to the end of setup()
+
+    def setup(self):
+        """Connect to redis and initialize tasks, once, inside the worker process."""
+        self.cannon = BotCannon()
+        # a consumer of our own, so pending entries show which process holds them
+        self.service = self.cannon.init(self._service_name,
+                                        consumer_name=f'{socket.gethostname()}-{os.getpid()}-{uuid4().hex[:6]}')
+        if self.persistent:
+            self.service.conf.watch()  # long-lived, follow config changes instead of asking on every init
+
+        ledger = self.service.ledger
+        self.channels = ledger.data_channels if self.partitions is None else \
+            [ledger.data_channels[int(i)] for i in self.partitions]
+
+        retry = self.service.options.get('retry', {})
+        self.max_deliveries = int(retry.get('max_deliveries', self.max_deliveries))
+        if 'backoff_ms' in retry:  # failed messages are retried by whoever reclaims them once idle this long
+            self.reclaim_idle_ms = int(retry['backoff_ms'])
+
         t = self.service.get_tasks()
         for task in t:
             cls, params = t[task]
             self.tasks.append([task, cls(**params)] if params else [task, cls()])
 
+        specs = self.service.service.tasks or {}
+        self.task_timeouts = {i: float(specs[i]['timeout']) for i in specs if specs[i].get('timeout')}
+        self.message_timeout = float(self.service.options.get('workers', {}).get('message_timeout', 0))
+        self.results_only = self.service.options.get('workers', {}).get('taskback') == 'results'
+        for i in specs:
+            c = specs[i].get('cache')
+            if c:
+                self.caches[i] = ResultCache(self.service.ledger, i, c.get('key'), float(c.get('ttl', 3600)),
+                                             int(c.get('max_entries', 1024)), bool(c.get('shared', True)))
+
+        if self.task_timeouts or self.message_timeout:
+            for _, task in self.tasks:
+                if not isinstance(getattr(task, 'cancelled', None), threading.Event):
+                    task.cancelled = threading.Event()
+
+        instances = dict(self.tasks)
+        self.levels = [[(i, instances[i]) for i in level] for level in plan_tasks(specs)]
+        widest = max([len(i) for i in self.levels] or [1])
+        self.executor = ThreadPoolExecutor(widest, thread_name_prefix='task') if widest > 1 else None
+
+        self.metrics = self.service.metrics(self.service.ledger.consumer_name)
+        if self.metrics:
+            self.metrics.record('spawn_ms', (time() - self._created) * 1000)
+
+        if any('torch' in i for i, _ in self.tasks):
+            self.shells = self.shell_pool()
+
+    def shell_pool(self):
+        """ShellPool for the service's shell, in the mode of the shell spec's `lifecycle` if the shell allows it."""
+        if self.recall_shell:  # new everything, every time
+            def factory():
+                s, p = self.cannon.init(self.service.ledger.service_name).get_shell()
+                return s(**p) if p else s()
+            return ShellPool(factory, 'per_message', metrics=self.metrics)
+
+        s, p = self.service.get_shell()
+        lifecycle = self.service.options.get('shell', {}).get('lifecycle', {})
+        allowed = list(getattr(s, 'lifecycles', None) or ShellPool.modes)
+        mode = lifecycle.get('mode', allowed[0] if hasattr(s, 'lifecycles') else 'per_message')
+        if mode not in allowed:
+            print(f'[!] Shell {s.__name__} is not safe to run as "{mode}", using "{allowed[0]}" ({", ".join(allowed)}).')
+            mode = allowed[0]
+        return ShellPool(lambda: s(**p) if p else s(), mode, int(lifecycle.get('max_uses', 0)), self.metrics)
+
     def run(self) -> None:
-        for message in self.service.ledger.channels["data"].read(count=self.count, block=self.block):
-            results = {}
-            for yml_tasks in self.tasks:
-                if 'torch' in yml_tasks[0]:
+        self.setup()
+
+        handled = 0
+        try:
+            while True:
+                messages = self.reclaim() or self.service.ledger.read(self.channels, count=self.count,
+                                                                      block=self.block)
+                if messages:
+                    self.handle(messages)
+                    handled += len(messages)
+                    if self.processed is not None:
+                        with self.processed.get_lock():
+                            self.processed.value += len(messages)
+
+                if self.hung:
+                    # the stuck threads die with the process, the manager starts a fresh worker
+                    print(f'[R] {self.name} recycling, {len(self.hung)} task threads still running past their deadline.')
+                    break
+
+                if not self.persistent or self.stop.is_set() or self.recycle(handled):
+                    break
+        finally:
+            self.shells.close() if self.shells else None
+            self.metrics.close() if self.metrics else None
+
+    def deadline(self, name, message_ids):
+        """
+        Seconds a call may take: the task's timeout, capped by the least any of its messages has left of
+        message_timeout, counted in wall time since handle() took them on (tasks of a level overlap).
+        """
+        limits = [self.task_timeouts[name]] if name in self.task_timeouts else []
+        if self.message_timeout:
+            now = time()
+            limits.append(min(self.message_timeout - (now - self._started.get(i, now)) for i in message_ids))
+        return min(limits) if limits else None
+
+    def call(self, name, task, message_ids, fn):
+        """
+        fn() under the deadline of its task and messages. Runs on a daemon thread that is abandoned when it
+        overruns: the task's `cancelled` event is set so it can stop cooperatively, and TaskTimeout is raised.
+        A task left running on such a thread fails every later call until the worker recycles.
+        """
+        if name in self.hung_tasks:
+            raise TaskTimeout('an earlier call is still running past its deadline')
+        timeout = self.deadline(name, message_ids)
+        if timeout is not None and timeout <= 0:  # nothing left to run it in, no thread to abandon
+            raise TaskTimeout('message_timeout spent before the call')
+        if timeout is None:
+            started = time()
+            try:
+                return fn()
+            finally:
+                self.metrics.record('task_ms', (time() - started) * 1000, name) if self.metrics else None
+
+        box = {}
+
+        def target():
+            try:
+                box['r'] = fn()
+            except Exception as e:
+                box['e'] = e
+
+        started = time()
+        t = threading.Thread(target=target, daemon=True, name=f'task-{name}')
+        t.start()
+        t.join(timeout)
+        self.metrics.record('task_ms', (time() - started) * 1000, name) if self.metrics else None
+
+        if t.is_alive():
+            cancelled = getattr(task, 'cancelled', None)
+            if isinstance(cancelled, threading.Event):
+                cancelled.set()
+            self.hung.append(t)
+            self.hung_tasks.add(name)
+            if self.timeouts is not None:
+                with self.timeouts.get_lock():
+                    self.timeouts.value += 1
+            raise TaskTimeout(f'ran past {timeout:.1f}s')
+
+        if 'e' in box:
+            raise box['e']
+        return box.get('r')
+
+    def reclaim(self):
+        """Messages left unacked by dead or stuck consumers, checked every reclaim_interval."""
+        if time() - self._reclaimed < self.reclaim_interval:
+            return []
+        self._reclaimed = time()
+
+        ledger = self.service.ledger
+        kept = []
+        for channel in self.channels:
+            messages = ledger.autoclaim(channel, self.reclaim_idle_ms, count=max(self.count, 10))
+            if not messages:
+                continue
+
+            # anything delivered more often than allowed (e.g. it keeps killing workers) goes straight to deadletter
+            counts = ledger.deliveries(channel, [m.message_id for m in messages])
+            over = [m for m in messages if counts[m.message_id] > self.max_deliveries]
+            if over:
+                ledger.deadletter(channel, over, {m.message_id: f'over {self.max_deliveries} deliveries' for m in over},
+                                  counts)
+
+            print(f'[C] {self.name} reclaimed {len(messages)} idle messages of {channel}, {len(over)} to deadletter.')
+            kept.extend(m for m in messages if counts[m.message_id] <= self.max_deliveries)
+        return kept
+
+    def recycle(self, handled):
+        if self.max_messages and handled >= self.max_messages:
+            print(f'[R] {self.name} recycling after {handled} messages.')
+            return True
+
+        if self.max_rss_mb:
+            rss = psutil.Process().memory_info().rss / 1024 ** 2
+            if rss > self.max_rss_mb:
+                print(f'[R] {self.name} recycling at {rss:.0f}MB rss after {handled} messages.')
+                return True
+
+        return False
+
+    def run_task(self, name, task, live):
+        """
+        One task over the live [(message, results)], without touching results.
+        Returns [(results, task result)] and {message_id: reason} for messages it failed on.
+        Tasks with a cache are only computed for messages whose key isn't cached yet.
+        """
+        cache = self.caches.get(name)
+        if not cache:
+            return self.compute(name, task, live)
+
+        # the cache only saves work, when it fails the task is computed as if it had none
+        try:
+            digests = [cache.digest(m, r) for m, r in live]
+            found = cache.get_many(digests)
+        except Exception as e:
+            print(f'[!] Cache of {name} failed: {e!r}')
+            return self.compute(name, task, live)
+        out = [(r, f) for (_, r), f in zip(live, found) if f is not MISSING]
+        misses = [i for i, f in zip(live, found) if f is MISSING]
+        if not misses:
+            return out, {}
+
+        computed, failed = self.compute(name, task, misses)
+        digest_of = {id(r): d for (_, r), d in zip(live, digests)}
+        try:
+            cache.set_many({digest_of[id(results)]: r for results, r in computed})
+        except Exception as e:
+            print(f'[!] Cache of {name} failed: {e!r}')
+        return out + computed, failed
+
+    def compute(self, name, task, live):
+        """run_task without the cache."""
+        out, failed = [], {}
+        if 'torch' in name:
+            for message, results in live:
+                try:
                     # fire/torch has needs (the shell class)
-                    if self.recall_shell:  # new everything
-                        s = self.cannon.init(self.service.ledger.service_name)
-                        s, p = s.get_shell()
-                    else:
-                        s, p = self.service.get_shell()
-                    c = s(**p) if p else s()
-                    r = yml_tasks[1].task(c, message, **results)
-                    [results.setdefault(i, r[i]) for i in r]
-                else:
-                    r = yml_tasks[1].task(message, **results)
+                    with self.shells.shell() as c:
+                        out.append((results, self.call(name, task, [message.message_id],
+                                                       lambda: task.task(c, message, **results))))
+                except Exception as e:
+                    failed[message.message_id] = f'{name}: {e!r}'
+
+        elif batch_capable(task):
+            try:
+                rs = self.call(name, task, [m.message_id for m, _ in live],
+                               lambda: task.task_batch([i[0] for i in live], [dict(i[1]) for i in live])) or []
+                out = [(results, r) for (_, results), r in zip(live, rs)]
+            except Exception as e:
+                failed = {m.message_id: f'{name}: {e!r}' for m, _ in live}
+
+        else:
+            for message, results in live:
+                try:
+                    out.append((results, self.call(name, task, [message.message_id],
+                                                   lambda: task.task(message, **results))))
+                except Exception as e:
+                    failed[message.message_id] = f'{name}: {e!r}'
+
+        return out, failed
+
+    def handle(self, messages):
+        """
+        Run every task over a read's messages, then write taskbacks and ack them all in one pipeline.
+        Tasks of a level run concurrently, each sees the results of the levels before it and results
+        are merged in yml order, first value for a key wins.
+        A message whose task raises skips its remaining tasks and stays pending, to be reclaimed after the
+        retry backoff, until it reaches max_deliveries and is moved to deadletter.
+        """
+        if self.metrics:
+            [self.metrics.since('queue_ms', m.message_id) for m in messages]
+
+        ledger = self.service.ledger
+        results_list = [{} for _ in messages]
+        failed = {}  # message_id: reason
+        self._started = dict.fromkeys((m.message_id for m in messages), time())
+        for level in self.levels:
+            live = [(m, r) for m, r in zip(messages, results_list) if m.message_id not in failed]
+            if not live:
+                break
+
+            if len(level) == 1:
+                runs = [self.run_task(*level[0], live)]
+            else:
+                runs = list(self.executor.map(lambda t: self.run_task(*t, live), level))
+
+            for out, f in runs:
+                failed.update(f)
+                for results, r in out:
                     if r:
                         [results.setdefault(i, r[i]) for i in r]
 
-            if results:
-                self.service.ledger.write('taskback', {**message.data, **results})
+        taskbacks = []
+        for message, results in zip(messages, results_list):
+            if results and message.message_id not in failed:
+                if self.results_only:  # the collector can fetch the message with ledger.source()
+                    taskbacks.append({'_source': ledger.channel_of(message), '_source_id': message.message_id,
+                                      **results})
+                else:
+                    taskbacks.append({**message.data, **results})
                 print(f'[M] {message.message_id} | {self.block} |'
                       f' IN:[{", ".join(i for i in message.data)}]'
                       f' OUT:[{", ".join(i for i in results)}]')
-            self.service.ledger.channels['data'].ack(message.message_id)
+
+        channels = {}  # channel: [messages], partitions are acked on their own stream
+        for m in messages:
+            channels.setdefault(ledger.channel_of(m), []).append(m)
+
+        done = [m.message_id for m in messages if m.message_id not in failed]
+        acks, dead_letters, counts = {}, [], {}
+        for channel, ms in channels.items():
+            dead = []
+            if any(m.message_id in failed for m in ms):
+                counts.update(ledger.deliveries(channel, [m.message_id for m in ms if m.message_id in failed]))
+                dead = [m for m in ms if m.message_id in failed and counts[m.message_id] >= self.max_deliveries]
+                dead_letters.extend(ledger.dead_letters(channel, dead, failed, counts))
+            acks[channel] = [m.message_id for m in ms if m.message_id not in failed] + [m.message_id for m in dead]
+        for i in failed:
+            print(f'[E] {i} | delivery {counts[i]}/{self.max_deliveries} | {failed[i]}')
+
+        ledger.finish_many(acks, {'taskback': taskbacks, 'deadletter': dead_letters})
+        if self.metrics:
+            [self.metrics.since('done_ms', i) for i in done]
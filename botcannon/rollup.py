@@ -0,0 +1,173 @@
+import math
+import socket
+from time import sleep
+from datetime import datetime
+
+from redis.exceptions import ResponseError
+
+from .codec import decode
+
+RESOLUTIONS = {'1m': 60, '1h': 3600, '1d': 86400}
+
+# KEYS: bucket hash, bucket index. ARGV: bucket start, count, sum, min, max, last, ttl
+MERGE_BUCKET = """
+local mn = redis.call('HGET', KEYS[1], 'min')
+local mx = redis.call('HGET', KEYS[1], 'max')
+redis.call('HINCRBY', KEYS[1], 'count', ARGV[2])
+redis.call('HINCRBYFLOAT', KEYS[1], 'sum', ARGV[3])
+if not mn or tonumber(ARGV[4]) < tonumber(mn) then redis.call('HSET', KEYS[1], 'min', ARGV[4]) end
+if not mx or tonumber(ARGV[5]) > tonumber(mx) then redis.call('HSET', KEYS[1], 'max', ARGV[5]) end
+redis.call('HSET', KEYS[1], 'last', ARGV[6])
+redis.call('ZADD', KEYS[2], ARGV[1], ARGV[1])
+if tonumber(ARGV[7]) > 0 then redis.call('EXPIRE', KEYS[1], ARGV[7]) end
+"""
+
+
+class Rollups:
+    """
+    Incremental count/sum/min/max/last of numeric fields of a service's data stream, bucketed at several
+    resolutions. Reads the stream (every partition of it) through a consumer group of its own, so it never
+    competes with workers.
+
+        {namespace}|rollup:{service}:{resolution}:{field}            zset of bucket starts
+        {namespace}|rollup:{service}:{resolution}:{field}:{bucket}   hash count, sum, min, max, last
+
+    :param fields: fields to roll up, default every field whose value parses as a number
+    :param resolutions: any of RESOLUTIONS
+    :param keep: {resolution: seconds} to expire buckets after, default forever
+    """
+    group_name = 'ROLLUP'
+
+    def __init__(self, ledger, fields=None, resolutions=('1m', '1h', '1d'), keep=None):
+        unknown = [i for i in resolutions if i not in RESOLUTIONS]
+        if unknown:
+            print(f'Unknown rollup resolutions {unknown}, use {list(RESOLUTIONS)}')
+            exit(1)
+        self.ledger = ledger
+        self.db = ledger.s.db
+        self.keys = [ledger.stream_key(i) for i in ledger.data_channels]
+        self.fields = set(fields) if fields else None
+        self.resolutions = list(resolutions)
+        self.keep = keep or {}
+        self.prefix = f'{ledger.s.conf.name}|rollup:{ledger.service_name}'
+        # the same on every run, so entries a stopped run read but didn't ack are picked up by the next one
+        self.consumer_name = f'{socket.gethostname()}-rollup'
+        self._merge = self.db.register_script(MERGE_BUCKET)
+
+    def create(self, cursor='$'):
+        """Consumer group for the rollups, '$' to start with new messages or '0' to roll up the whole stream."""
+        for key in self.keys:
+            try:
+                self.db.xgroup_create(key, self.group_name, cursor, mkstream=True)
+            except ResponseError as e:
+                if not str(e).startswith('BUSYGROUP'):
+                    raise
+
+    def aggregate(self, messages):
+        """{(resolution, field, bucket): [count, sum, min, max, last]} for (message_id, data) pairs."""
+        buckets = {}
+        for message_id, data in messages:
+            mid = message_id.decode() if isinstance(message_id, bytes) else message_id
+            seconds = int(mid.partition('-')[0]) // 1000
+            for field, value in decode(data).items():
+                if self.fields is not None and field not in self.fields:
+                    continue
+                try:
+                    value = float(value)
+                except (TypeError, ValueError):
+                    continue
+                if not math.isfinite(value):  # nan, inf, 1e400: HINCRBYFLOAT refuses them
+                    continue
+                for res in self.resolutions:
+                    span = RESOLUTIONS[res]
+                    b = buckets.get((res, field, seconds // span * span))
+                    if b:
+                        b[0] += 1
+                        b[1] += value
+                        b[2] = min(b[2], value)
+                        b[3] = max(b[3], value)
+                        b[4] = value
+                    else:
+                        buckets[(res, field, seconds // span * span)] = [1, value, value, value, value]
+        return buckets
+
+    def recover(self, min_idle_ms=60000, count=500):
+        """
+        Roll up entries left pending: ours from an earlier run, and those other consumers (e.g. of another
+        host, or from before consumer names were stable) have held past min_idle_ms. Pending entries pin the
+        acked floor, so retention and archiving stop until they are acked. Returns how many were rolled up.
+        """
+        for key in self.keys:
+            start = '0-0'
+            while True:
+                start, *_ = self.db.xautoclaim(key, self.group_name, self.consumer_name, min_idle_ms,
+                                               start_id=start, count=count)
+                start = start.decode() if isinstance(start, bytes) else start
+                if start == '0-0':
+                    break
+
+        rolled = 0
+        while True:  # our pending entries, read back from the start of our history
+            n = self.consume(count, ids='0')
+            if not n:
+                return rolled
+            rolled += n
+
+    def consume(self, count=500, block=1000, ids='>'):
+        """
+        Read, merge and ack one batch in one pipeline, returns how many messages were read.
+        ids='0' reads this consumer's pending entries instead of new ones.
+        """
+        resp = self.db.xreadgroup(self.group_name, self.consumer_name, {i: ids for i in self.keys}, count,
+                                  block if ids == '>' else None)
+        if not any(items for _, items in resp or []):
+            return 0
+        # pending entries trimmed meanwhile come back without data, they are only acked
+        messages = [i for _, items in resp for i in items if i[1]]
+
+        pipe = self.db.pipeline(transaction=False)
+        for (res, field, bucket), (n, total, low, high, last) in self.aggregate(messages).items():
+            index = f'{self.prefix}:{res}:{field}'
+            self._merge(keys=[f'{index}:{bucket}', index],
+                        args=[bucket, n, total, low, high, last, int(self.keep.get(res, 0))],
+                        client=pipe)
+            pipe.sadd(f'{self.prefix}:fields', field)
+            if self.keep.get(res):  # expired buckets leave their start behind in the index
+                pipe.zremrangebyscore(index, '-inf', bucket - int(self.keep[res]) - RESOLUTIONS[res])
+        for key, items in resp:
+            pipe.xack(key, self.group_name, *[i[0] for i in items]) if items else None
+        pipe.execute()
+        return sum(len(items) for _, items in resp)
+
+    def run(self, count=500, block=1000, stop=None):
+        """Keep the rollups current until the `stop` Event is set, checked between batches."""
+        self.create()
+        print(f'Rolling up {", ".join(self.keys)} at {", ".join(self.resolutions)}')
+        recovered = self.recover(count=count)
+        print(f'Rolled up {recovered} pending entries.') if recovered else None
+        pending = False  # a failed batch is left pending to us, read it back before anything new
+        while not (stop and stop.is_set()):
+            try:
+                if pending:
+                    pending = bool(self.consume(count, ids='0'))
+                else:
+                    self.consume(count, block)
+            except Exception as e:
+                print(f'[!] Rollup of {self.ledger.service_name} failed: {e!r}, retrying.')
+                pending = True
+                sleep(1)
+
+    def all_fields(self):
+        return sorted(i.decode() for i in self.db.smembers(f'{self.prefix}:fields'))
+
+    def buckets(self, field, resolution='1h', begin: datetime = None, end: datetime = None):
+        """[(bucket start, {count, sum, min, max, last})] between begin and end, oldest first."""
+        index = f'{self.prefix}:{resolution}:{field}'
+        low = int(begin.timestamp()) // RESOLUTIONS[resolution] * RESOLUTIONS[resolution] if begin else '-inf'
+        high = int(end.timestamp()) if end else '+inf'
+        starts = [int(float(i)) for i in self.db.zrangebyscore(index, low, high)]
+
+        pipe = self.db.pipeline(transaction=False)
+        [pipe.hgetall(f'{index}:{i}') for i in starts]
+        return [(i, {k.decode(): float(v) for k, v in b.items()})
+                for i, b in zip(starts, pipe.execute()) if b]  # empty if the bucket expired
@@ -1,23 +1,34 @@
 import importlib.util
 from pathlib import Path
 import inspect
-
-from walrus.streams import TimeSeriesStream, datetime_to_id
-from walrus import Database
+import json
+import queue
+import threading
+import zlib
+from datetime import datetime, timedelta
+from time import time, sleep
+
+from walrus.streams import TimeSeriesStream, Message, datetime_to_id, normalize_id
 from redis.exceptions import ResponseError
 
-from .config import ConfigManager
-from .stream_frame import BlindDataFrames
+from . import transport
+from .codec import Codec, decode
+from .config import ConfigManager, ServiceSnapshot
+
+AGES = ['weeks', 'days', 'hours', 'minutes', 'seconds']  # age keys of a retention policy
 
 
 class BotCannonService:
-    def __init__(self, service_name, namespace, paths_dict, socket_path, hardfail, consumer_name='CANNON', **kwargs):
-        self.db = Database(unix_socket_path=str(socket_path.resolve()))
+    def __init__(self, service_name, namespace, paths_dict, redis_url, hardfail, consumer_name=None,
+                 group_name='CANNON', db=None, **kwargs):
+        self.redis_url = redis_url
+        self.db = db or transport.database(redis_url)  # the process' pool, shared with every other service
         self.conf = ConfigManager(namespace, self.db)
-        self.ledger = CannonLedger(self, service_name, consumer_name)
         self.paths_dict = paths_dict
 
-        service = self.conf.service.get(service_name)
+        # one snapshot of the service and its params, usually served from this process' cache
+        snapshot = self.conf.snapshot(service_name)
+        service = ServiceSnapshot(snapshot) if snapshot else None
         if not service:
             print(f'No service named "{service_name}"')
             exit(1) if hardfail else None
@@ -36,49 +47,113 @@ class BotCannonService:
             exit(1) if hardfail else None
 
         self.service = service
-        self.dataframes = BlindDataFrames(self)
+        self.options = service.options or {}
+        self.ledger = CannonLedger(self, service_name, group_name, consumer_name)
+
+        archive = self.options.get('archive')
+        if archive:
+            # age retention trims on every write, a shorter window would drop entries before they are archived
+            policy = self.ledger._retention('data')
+            window = timedelta(**{i: float(policy[i]) for i in policy if i in AGES})
+            after = timedelta(**archive.get('after', {'days': 7}))
+            if window and window < after:
+                print(f'Retention of data ({window}) is shorter than archive after ({after}), entries would be '
+                      f'trimmed before they are archived.')
+                exit(1) if hardfail else None
+
+        self._dataframes = None
+        self._archives = {}
+        self._rollups = None
+
+    @property
+    def archive(self):
+        """StreamArchive of the data channel if the service yml has an `archive` section, else None."""
+        return self.archive_of('data')
+
+    def archive_of(self, channel):
+        """StreamArchive of a data channel (or partition) if the service yml has an `archive` section, else None."""
+        conf = self.options.get('archive')
+        if conf and channel not in self._archives:
+            from .archive import StreamArchive
+            self._archives[channel] = StreamArchive(self.ledger, channel, conf.get('path', './archive'),
+                                                    conf.get('partition', 'hour'))
+        return self._archives.get(channel)
+
+    @property
+    def rollups(self):
+        """Rollups of the data stream if the service yml has a `rollup` section, else None."""
+        conf = self.options.get('rollup')
+        if conf and self._rollups is None:
+            from .rollup import Rollups
+            self._rollups = Rollups(self.ledger, conf.get('fields'), conf.get('resolutions', ['1m', '1h', '1d']),
+                                    conf.get('keep'))
+        return self._rollups
+
+    def metrics(self, source):
+        """Metrics flushed to the log stream for one process, None if the service yml sets `metrics: flush_s: 0`."""
+        flush_s = float(self.options.get('metrics', {}).get('flush_s', 10))
+        if not flush_s:
+            return None
+        from .metrics import Metrics
+        return Metrics(self.ledger, source, flush_s)
+
+    def cache_stats(self):
+        """Hits and misses of every task result cache, as counted by all workers."""
+        from .cache import ResultCache
+        specs = self.service.tasks or {}
+        cached = [i for i in specs if specs[i].get('cache')]
+        if not cached:
+            print('No task of this service has a cache.')
+            return
+        for i in cached:
+            stats = ResultCache(self.ledger, i, specs[i]['cache'].get('key')).stats()
+            total = sum(stats.values())
+            ratio = (stats['local'] + stats['shared']) / total if total else 0.0
+            print(f'{i}: {stats["local"]} local hits, {stats["shared"]} shared hits, {stats["miss"]} misses, '
+                  f'{ratio:.1%} hit ratio')
+
+    @property
+    def dataframes(self):
+        """BlindDataFrames for this service, pandas is only imported on first access."""
+        if self._dataframes is None:
+            from .stream_frame import BlindDataFrames
+            self._dataframes = BlindDataFrames(self)
+        return self._dataframes
 
     def _get_entry(self, py_file_path: Path, class_in_spec, config_key, checks=True, hardfail=True):
-        # hijack python's import system
-        name = py_file_path.stem
-        plugin = f'{py_file_path.parent}.{name}'
-        py_spec = importlib.util.find_spec(plugin)
-        module = importlib.util.module_from_spec(py_spec)
-        py_spec.loader.exec_module(module)
-
-        # look for our entry point
-        if class_in_spec in module.__dict__:
-            desired_class = module.__dict__[class_in_spec]
-        else:
-            print(f'Entrypoint, {class_in_spec}, not found in {py_spec}')
+        entry = entry_cache.entry(py_file_path, class_in_spec)
+        if not entry:
+            print(f'Entrypoint, {class_in_spec}, not found in {py_file_path}')
             return False
+        desired_class, service_sig = entry
 
         params = {}
-        kwargs_for_class = self.conf.params.get(config_key)
-        if not kwargs_for_class:
+        kwargs_for_class = self.service.params(config_key)
+        if kwargs_for_class is None:
             print(f'parameter entry  "{config_key}" not found.\n'
                   f'    Create with "conf params add {config_key}"')
             return exit(1) if hardfail else None
 
         if checks:
-            # return self._check_class_parameters(desired_class, kwargs_for_class)
-            service_sig = inspect.signature(desired_class.__init__).parameters
-
-            failed = [i for i in service_sig if (i not in kwargs_for_class.data and i is not 'self')]
+            failed = [i for i in service_sig if (i not in kwargs_for_class and i is not 'self')]
             defaults = [params.setdefault(i, service_sig.get(i).default) for i in failed if service_sig.get(i).default is not service_sig.get(i).empty]
             if failed and not defaults:
                 print(f'Parameter object is missing key(s):\n'
-                      f'    Create with "su params paste {kwargs_for_class.name} ', end='')
+                      f'    Create with "su params paste {config_key} ', end='')
                 print(' '.join(i for i in failed), end='"\n')
                 exit(1)
             else:
-                passed = [i for i in service_sig if i in kwargs_for_class.data]
-                [params.setdefault(i, kwargs_for_class.data[i].decode()) for i in passed]
+                passed = [i for i in service_sig if i in kwargs_for_class]
+                [params.setdefault(i, kwargs_for_class[i]) for i in passed]
             return desired_class, params
         else:
-            [params.setdefault(i, kwargs_for_class.data[i].decode()) for i in kwargs_for_class.data]
+            [params.setdefault(i, kwargs_for_class[i]) for i in kwargs_for_class]
             return desired_class, params
 
+    def invalidate_entries(self, file_name=None):
+        """Forget cached plugin modules, for one file in the lib dir or all of them."""
+        entry_cache.invalidate(self.paths_dict[file_name] if file_name else None)
+
     def get_shell(self):
         return self._get_entry(self.paths_dict[self.service.shell], self.service.s_entry, self.service.s_conf)
 
@@ -89,21 +164,77 @@ class BotCannonService:
         t = self.service.tasks
         d = {}
         for i in t:
-            d[i] = self._get_entry(self.paths_dict[t[i]["lib"]], t[i]["entry"], t[i]["conf"]["key"])
+            d[i] = self._get_entry(self.paths_dict[t[i].get("file", t[i].get("lib"))], t[i]["entry"], t[i]["conf"]["key"])
             # self.service.tasks[i]
         return d
 
 
+class EntryCache:
+    """
+    Plugin modules loaded from the lib dir, with their resolved entry classes and __init__ signatures.
+    Keyed by file path and checked against the file's mtime, so an edited plugin is loaded fresh.
+    """
+    def __init__(self):
+        self._modules = {}  # path: (mtime, module, {class_name: (class, signature parameters)})
+
+    def module(self, py_file_path: Path):
+        key = str(py_file_path)
+        mtime = py_file_path.stat().st_mtime_ns
+        cached = self._modules.get(key)
+        if cached and cached[0] == mtime:
+            return cached[1]
+
+        # hijack python's import system
+        plugin = f'{py_file_path.parent}.{py_file_path.stem}'
+        py_spec = importlib.util.find_spec(plugin)
+        module = importlib.util.module_from_spec(py_spec)
+        py_spec.loader.exec_module(module)
+
+        self._modules[key] = (mtime, module, {})
+        return module
+
+    def entry(self, py_file_path: Path, class_in_spec):
+        """(class, signature parameters), or None if the module has no such entry point."""
+        module = self.module(py_file_path)
+        classes = self._modules[str(py_file_path)][2]
+        if class_in_spec not in classes:
+            # look for our entry point
+            if class_in_spec not in module.__dict__:
+                return None
+            desired_class = module.__dict__[class_in_spec]
+            classes[class_in_spec] = (desired_class, inspect.signature(desired_class.__init__).parameters)
+        return classes[class_in_spec]
+
+    def invalidate(self, py_file_path: Path = None):
+        if py_file_path:
+            self._modules.pop(str(py_file_path), None)
+        else:
+            self._modules.clear()
+
+
+entry_cache = EntryCache()
+
+
 class CannonLedger:
-    def __init__(self, service: BotCannonService, service_name, consumer_name):
+    def __init__(self, service: BotCannonService, service_name, group_name, consumer_name=None):
         self.s = service
         self.service_name = service_name
-        self.consumer_name = consumer_name
+        self.group_name = group_name
+        self.consumer_name = consumer_name or f'{group_name}.c1'  # walrus' default consumer
+
+        # with `partitions: count: N` data is written to N streams: data, data_1 ... data_{N-1}
+        partitions = (getattr(self.s, 'options', None) or {}).get('partitions', {})
+        self.partitions = max(1, int(partitions.get('count', 1)))
+        self.route_key = partitions.get('key')  # fields to hash, else round-robin
+        self.route_key = [self.route_key] if isinstance(self.route_key, str) else self.route_key
+        self.data_channels = ['data'] + [f'data_{i}' for i in range(1, self.partitions)]
+        self._next = 0
+        self._codecs = {}  # channel: Codec, from the service yml's `codec` section
 
         # prepare streams and consumer groups
-        self.channel_keys = ['log', 'data', 'taskback']
+        self.channel_keys = ['log', *self.data_channels, 'taskback', 'deadletter']
         self.stream_keys = [f'{self.s.conf.name}|streams:{self.service_name}:{i}' for i in self.channel_keys]
-        self.ts = self.s.db.time_series(self.consumer_name, self.stream_keys)
+        self.ts = self.s.db.time_series(self.group_name, self.stream_keys, consumer=self.consumer_name)
         self.channels = {}
         for cgkey in self.channel_keys:
             self.channels[cgkey] = self._get_cg(cgkey)
@@ -138,25 +269,115 @@ class CannonLedger:
 
         # create something more digestible for our us
         groups = {}
-        for key in self.stream_keys:
-            try:
-                q = self.s.db.xinfo_groups(key)
-            except ResponseError:
+        pipe = self.s.db.pipeline(transaction=False)
+        [pipe.xinfo_groups(key) for key in self.stream_keys]
+        for key, q in zip(self.stream_keys, pipe.execute(raise_on_error=False)):
+            if isinstance(q, ResponseError):  # no such stream yet
                 q = None
             groups[key] = {i['name'].decode(): i for i in q} if q else {}
 
         # check for existing consumer groups
-        test = [groups[i] for i in groups if self.consumer_name in groups[i]]
+        test = [groups[i] for i in groups if self.group_name in groups[i]]
 
         # create the streams and set our 'cursor' if test is empty
         if force or not test:
             self.ts.create()
             self.ts.set_id(cursor)
             return True  # new/change
+        # a channel added since the group was made, create the group there without moving existing cursors
+        elif len(test) < len(self.stream_keys):
+            self.ts.create()
+            return True
         # otherwise the consumer groups is ready
         else:
             return False  # no change
 
+    def stream_key(self, channel):
+        return self.stream_keys[self.channel_keys.index(channel)]
+
+    def route(self, data: dict):
+        """
+        Data partition a message is written to. With a routing key every message with the same values
+        lands in the same partition, in the order written, otherwise partitions take turns.
+        """
+        if self.partitions == 1:
+            return 'data'
+        if self.route_key:
+            values = json.dumps([data.get(i) for i in self.route_key], default=str).encode()
+            return self.data_channels[zlib.crc32(values) % self.partitions]
+        self._next = (self._next + 1) % self.partitions
+        return self.data_channels[self._next]
+
+    def channel_of(self, message: Message):
+        """Channel a Message was read from."""
+        return self.channel_keys[self.stream_keys.index(message.stream)]
+
+    def codec(self, channel):
+        """
+        Codec entries of a channel are written with, partitions share the one of 'data'. Channels that copy
+        data messages (deadletter, and taskback unless workers send results only) default to the data codec,
+        so values plain fields can't hold still fit.
+        """
+        channel = 'data' if channel in self.data_channels else channel
+        if channel not in self._codecs:
+            options = getattr(self.s, 'options', None) or {}
+            codecs = options.get('codec', {})
+            copies = ['deadletter'] + (['taskback'] if options.get('workers', {}).get('taskback') != 'results' else [])
+            conf = codecs.get(channel, codecs.get('data', {}) if channel in copies else {})
+            self._codecs[channel] = Codec(**conf)
+        return self._codecs[channel]
+
+    @staticmethod
+    def message(key, message_id, fields: dict):
+        """Message of a stream entry as it came from redis, decoded whatever codec wrote it."""
+        m = Message(key, message_id, {})
+        m.data = decode(fields)  # as is, walrus would try to utf-8 decode packed bytes values
+        return m
+
+    def read(self, channels, count=1, block=0):
+        """One XREADGROUP of new messages over several channels, as Messages."""
+        resp = self.s.db.xreadgroup(self.group_name, self.consumer_name, {self.stream_key(i): '>' for i in channels},
+                                    count=count, block=block)
+        return [self.message(key, i, data) for key, items in resp or [] for i, data in items]
+
+    def source(self, taskback: Message):
+        """
+        Data message a results-only taskback (`workers: taskback: results`) answers, from its `_source` and
+        `_source_id`. None once it is trimmed away.
+        """
+        key = self.stream_key(taskback.data.get('_source', 'data'))
+        i = taskback.data['_source_id']
+        items = self.s.db.xrange(key, min=i, max=i, count=1)
+        return self.message(key, *items[0]) if items else None
+
+    def backlog(self, channel='data'):
+        """
+        Pending (delivered, not acked) and lag (not delivered yet) of our consumer group on a channel.
+        For 'data', summed over every partition.
+        """
+        if channel == 'data' and self.partitions > 1:
+            per = [self._backlog(i) for i in self.data_channels]
+            return {'pending': sum(i['pending'] for i in per), 'lag': sum(i['lag'] for i in per)}
+        return self._backlog(channel)
+
+    def _backlog(self, channel):
+        key = self.stream_key(channel)
+        try:
+            groups = self.s.db.xinfo_groups(key)
+        except ResponseError:
+            return {'pending': 0, 'lag': 0}
+
+        for group in groups:
+            if group['name'].decode() != self.group_name:
+                continue
+            lag = group.get('lag')
+            if lag is None:  # redis < 7 (or lag not computable), count what is past the last delivered id
+                last = group['last-delivered-id']
+                last = last.decode() if isinstance(last, bytes) else last
+                lag = len(self.s.db.xrange(key, min=f'({last}', max='+', count=10000))
+            return {'pending': group['pending'], 'lag': lag}
+        return {'pending': 0, 'lag': 0}
+
     def write(self, channel, data: dict, ts: str = ''):
         """
         Write out dict to stream as k:v pairs.
@@ -167,11 +388,131 @@ class CannonLedger:
         :param ts: insert message at this time
         """
         if channel in self.channels:
-            self.channels[channel].add(data, id=ts) if ts else self.channels[channel].add(data)
+            self._xadd(self.s.db, channel, data, id=normalize_id(ts) if ts else '*')
         else:
             print('No consumer group to write to, exiting.')
             exit(1)
 
+    def write_many(self, channel, items: list):
+        """Write a list of dicts to a channel in one pipelined round trip."""
+        if channel not in self.channels:
+            print('No consumer group to write to, exiting.')
+            exit(1)
+        pipe = self.s.db.pipeline(transaction=False)
+        [self._xadd(pipe, channel, i) for i in items]
+        return pipe.execute()
+
+    def finish(self, channel, message_ids: list, writes: dict = None):
+        """
+        Ack message_ids on a channel along with any writes ({channel: [dicts]}) in one pipelined round trip.
+        Writes go first so nothing is acked before its taskback exists.
+        """
+        return self.finish_many({channel: message_ids}, writes)
+
+    def finish_many(self, acks: dict, writes: dict = None):
+        """finish() for acks on several channels, {channel: message_ids}."""
+        pipe = self.s.db.pipeline(transaction=False)
+        for ch in writes or {}:
+            [self._xadd(pipe, ch, i) for i in writes[ch]]
+        for ch in acks:
+            if acks[ch]:
+                pipe.xack(self.stream_key(ch), self.group_name, *acks[ch])
+        return pipe.execute()
+
+    def deliveries(self, channel, message_ids: list):
+        """{message_id: times delivered} for pending messages, from one pipelined round of XPENDING."""
+        key = self.stream_key(channel)
+        pipe = self.s.db.pipeline(transaction=False)
+        [pipe.xpending_range(key, self.group_name, min=i, max=i, count=1) for i in message_ids]
+        return {i: r[0]['times_delivered'] if r else 0 for i, r in zip(message_ids, pipe.execute())}
+
+    def dead_letters(self, channel, messages: list, reasons: dict, counts: dict = None):
+        """Deadletter entries for messages: their data plus why, where from and how many deliveries."""
+        counts = counts or {}
+        return [{**m.data,
+                 '_error': reasons.get(m.message_id, ''),
+                 '_source': channel,
+                 '_source_id': m.message_id,
+                 '_deliveries': str(counts.get(m.message_id, 0))} for m in messages]
+
+    def deadletter(self, channel, messages: list, reasons: dict, counts: dict = None):
+        """Move messages out of a channel to deadletter and ack them, in one pipeline."""
+        return self.finish(channel, [m.message_id for m in messages],
+                           {'deadletter': self.dead_letters(channel, messages, reasons, counts)})
+
+    def _xadd(self, client, channel, data: dict, id='*'):
+        if channel == 'data':
+            channel = self.route(data)
+        return client.xadd(self.stream_key(channel), self.codec(channel).encode(data), id=id, **self._trim_args(channel))
+
+    def _retention(self, channel):
+        """Retention policy for a channel from the service yml, e.g. {'maxlen': 100000}, {'days': 7} or {'acked': True}."""
+        options = getattr(self.s, 'options', None) or {}
+        if channel in self.data_channels:  # partitions share the policy of 'data'
+            channel = 'data'
+        return options.get('retention', {}).get(channel) or {}
+
+    def _trim_args(self, channel):
+        """MAXLEN/MINID arguments for XADD and XTRIM, approximate so redis trims whole nodes only."""
+        policy = self._retention(channel)
+        if 'maxlen' in policy:
+            return {'maxlen': int(policy['maxlen']), 'approximate': True}
+
+        age = {i: float(policy[i]) for i in policy if i in AGES}
+        if age:
+            return {'minid': datetime_to_id(datetime.now() - timedelta(**age)), 'approximate': True}
+        return {}
+
+    def _acked_floor(self, key):
+        """Lowest id any consumer group on the stream still needs, everything below it is acked by all groups."""
+        try:
+            groups = self.s.db.xinfo_groups(key)
+        except ResponseError:
+            return None
+        if not groups:
+            return None
+
+        floors = []
+        for group in groups:
+            if group['pending']:
+                first = self.s.db.xpending(key, group['name'])['min']
+            else:
+                first = group['last-delivered-id']
+                first = first.decode() if isinstance(first, bytes) else first
+                ms, seq = first.split('-')
+                first = f'{ms}-{int(seq) + 1}'
+            first = first.decode() if isinstance(first, bytes) else first
+            floors.append(tuple(int(i) for i in first.split('-')))
+        return '-'.join(str(i) for i in min(floors))
+
+    def trim(self):
+        """Apply the retention policy of every channel, returns {channel: bytes reclaimed (approximate)}."""
+        reclaimed = {}
+        for channel in self.channel_keys:
+            policy = self._retention(channel)
+            if not policy:
+                continue
+            key = self.stream_key(channel)
+            before = self.s.db.memory_usage(key) or 0
+
+            if policy.get('acked'):
+                floor = self._acked_floor(key)
+                if floor:
+                    self.s.db.xtrim(key, minid=floor, approximate=True)
+            else:
+                self.s.db.xtrim(key, **self._trim_args(channel))
+
+            reclaimed[channel] = before - (self.s.db.memory_usage(key) or 0)
+        return reclaimed
+
+    def batch(self, channel, size=500, flush_ms=5.0, on_flush=None):
+        """Buffered writer for a channel, see LedgerBatch."""
+        return LedgerBatch(self, channel, size, flush_ms, on_flush)
+
+    def taskback_pump(self, count=100, block_ms=1000, callback=None, metrics=None):
+        """Background reader of the taskback channel, see TaskbackPump."""
+        return TaskbackPump(self, count, block_ms, callback, metrics)
+
     def all_cgs(self):
         a = []
         for i in self.ts.__dict__:
@@ -200,11 +541,13 @@ class CannonLedger:
                 continue
 
             pending = stream.pending(count=10)
+            ids = []
             for i in pending:
                 ts, seq, group, age, delivered = self.parse_pending(i)
-                print(f'  {datetime_to_id(ts, seq)}', [group, age, delivered], end='')
-                ack = self.ack(s, datetime_to_id(ts, seq)) if churn else None
-                print(f' - {ack}') if ack else print('')
+                ids.append(datetime_to_id(ts, seq))
+                print(f'  {ids[-1]}', [group, age, delivered])
+            if churn and ids:
+                print(f'  acked {self.ack(s, *ids)}')
 
     def parse_pending(self, item):
         msgts_seq, group, age, delivered = item
@@ -249,7 +592,7 @@ class CannonLedger:
                     print('\n'.join([f'    {i}: {group[i]}' for i in group]))
                     print('    ---')
             try:
-                consumers = self.s.db.xinfo_consumers(key, self.consumer_name)
+                consumers = self.s.db.xinfo_consumers(key, self.group_name)
             except ResponseError:
                 consumers = None
 
@@ -262,15 +605,186 @@ class CannonLedger:
             print('')
 
     def ack(self, stream, *args):
+        """Ack ids in one XACK, `stream` being a channel name ('data') or a full stream key."""
+        if stream in self.channels and self.channels[stream]:
+            return self.channels[stream].ack(*args)
+
         stripped = stream.replace("-", "_").replace(":", "_").replace("|", "_").lower()
-        # stripped = stripped
         if stripped in self.ts.__dict__ and isinstance(self.ts.__dict__[stripped], TimeSeriesStream):
-            return [self.ts.__dict__[stripped].ack(i) for i in args]
+            return self.ts.__dict__[stripped].ack(*args)
         else:
             return False
 
+    def autoclaim(self, channel, min_idle_ms, count=100):
+        """Take over messages another consumer has held unacked for min_idle_ms (XAUTOCLAIM), as Messages."""
+        key = self.stream_key(channel)
+        resp = self.s.db.xautoclaim(key, self.group_name, self.consumer_name, min_idle_ms,
+                                    start_id='0-0', count=count)
+        # [next start id, [(id, data)], deleted ids (redis 7)], data is None for entries deleted meanwhile
+        return [self.message(key, i, data) for i, data in resp[1] if data]
+
+    def reap_consumers(self, channel, idle_ms):
+        """Delete consumers idle past idle_ms that hold no pending messages, returns their names."""
+        key = self.stream_key(channel)
+        try:
+            consumers = self.s.db.xinfo_consumers(key, self.group_name)
+        except ResponseError:
+            return []
+
+        reaped = []
+        for c in consumers:
+            name = c['name'].decode() if isinstance(c['name'], bytes) else c['name']
+            if name != self.consumer_name and c['idle'] > idle_ms and not c['pending']:
+                self.s.db.xgroup_delconsumer(key, self.group_name, name)
+                reaped.append(name)
+        return reaped
+
     def claim(self, cg_stream, id):
         """Bring a message back for processing """
         if cg_stream in self.channels:
             s = self.channels[cg_stream]
             return s.claim(id)
+
+
+class LedgerBatch:
+    """
+    Buffers writes to a channel and flushes them through a single pipeline once `size` items
+    are waiting or the oldest has waited `flush_ms`. The deadline is kept by a background thread,
+    so an item is never held back by a collector that is blocked waiting for its next one.
+    Items of a failed write stay buffered and the background thread retries them every second, add()
+    keeps buffering meanwhile. Only an explicit flush() or close() raises the error.
+
+    :param on_flush: called with the number of items after every flush
+    """
+    def __init__(self, ledger: CannonLedger, channel, size=500, flush_ms=5.0, on_flush=None):
+        self.ledger = ledger
+        self.channel = channel
+        self.size = max(1, size)
+        self.flush_ms = flush_ms
+        self.on_flush = on_flush
+
+        self.items = []
+        self._first = 0.0
+        self._lock = threading.Lock()  # guards items
+        self._flush_lock = threading.Lock()  # keeps flushes, and so stream order, serial
+        self._wake = threading.Event()
+        self._closed = False
+        self._failing = False  # the last write failed, retries are left to the background thread
+        self._thread = threading.Thread(target=self._deadline, daemon=True)
+        self._thread.start()
+
+    def add(self, data: dict):
+        with self._lock:
+            self.items.append(data)
+            if len(self.items) == 1:
+                self._first = time()
+                self._wake.set()
+            full = len(self.items) >= self.size and not self._failing
+        if full:
+            try:
+                self.flush()
+            except Exception as e:
+                print(f'[!] Flush of {len(self.items)} {self.channel} items failed: {e!r}, retrying.')
+                self._wake.set()
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                items, self.items = self.items, []
+            if items:
+                try:
+                    self.ledger.write_many(self.channel, items)
+                except Exception:
+                    with self._lock:  # back in front, to go out with the next flush
+                        self.items = items + self.items
+                        self._first = time()
+                        self._failing = True
+                    raise
+                self._failing = False
+                if self.on_flush:
+                    self.on_flush(len(items))
+            return len(items)
+
+    def close(self):
+        self._closed = True
+        self._wake.set()
+        return self.flush()
+
+    def _deadline(self):
+        while not self._closed:
+            self._wake.wait()
+            self._wake.clear()
+            with self._lock:
+                first, waiting = self._first, bool(self.items)
+            if not waiting:
+                continue
+            delay = first + self.flush_ms / 1000 - time()
+            if delay > 0:
+                sleep(delay)
+            try:
+                self.flush()
+            except Exception as e:
+                print(f'[!] Flush of {len(self.items)} {self.channel} items failed: {e!r}, retrying.')
+                sleep(1)
+                self._wake.set()
+
+
+class TaskbackPump:
+    """
+    Reads the taskback channel with a blocking XREADGROUP in a thread of its own and hands the batches to
+    the collector's thread through deliver(), so taskbacks neither wait on the collector's read() nor get
+    polled for. With a `callback` (a collector declaring `threadsafe_taskback = True`) batches are delivered
+    from the thread right away. With `metrics`, the time from each taskback's write to its delivery is recorded.
+    """
+    def __init__(self, ledger: CannonLedger, count=100, block_ms=1000, callback=None, metrics=None):
+        self.ledger = ledger
+        self.stream = ledger.channels['taskback']
+        self.count = count
+        self.block_ms = block_ms
+        self.callback = callback
+        self.metrics = metrics
+
+        self.batches = queue.Queue()
+        self._closed = False
+        self._thread = threading.Thread(target=self._read, daemon=True)
+        self._thread.start()
+
+    def _read(self):
+        while not self._closed:
+            try:
+                messages = self.ledger.read(['taskback'], count=self.count, block=self.block_ms)
+                if not messages:
+                    continue
+                if self.callback:
+                    [self.callback(i) for i in messages]
+                    self._done(messages)
+                else:
+                    self.batches.put(messages)
+            except Exception as e:
+                # a failed batch stays pending, the pump keeps going so taskbacks don't silently stop
+                print(f'[!] Taskback pump of {self.ledger.service_name}: {e!r}, retrying.')
+                sleep(1)
+
+    def deliver(self, taskback, wait=0.0):
+        """
+        Call taskback for every waiting message, acking each batch with one XACK.
+        Waits up to `wait` seconds for the first batch, returns how many were delivered.
+        """
+        delivered = 0
+        try:
+            messages = self.batches.get(timeout=wait) if wait else self.batches.get_nowait()
+            while True:
+                [taskback(i) for i in messages]
+                self._done(messages)
+                delivered += len(messages)
+                messages = self.batches.get_nowait()
+        except queue.Empty:
+            return delivered
+
+    def _done(self, messages):
+        self.stream.ack(*[i.message_id for i in messages])
+        if self.metrics:
+            [self.metrics.since('taskback_ms', i.message_id) for i in messages]
+
+    def close(self):
+        self._closed = True
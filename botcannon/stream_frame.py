@@ -1,80 +1,202 @@
+import heapq
+from array import array
 from datetime import datetime, timedelta
 
-from pandas import DataFrame
+import numpy as np
+from pandas import DataFrame, Series, Categorical, arrays, to_datetime, to_numeric
 from walrus import Message
+from walrus.streams import datetime_to_id
+
+from .archive import parse_id
 
 
 
 
 class TimeFrames:
-    def __init__(self, service):
+    def __init__(self, service, page=1000):
         self.service = service
+        self.page = page  # entries per XRANGE
 
-    def _get_range(self, end, **kwargs):
-        kw = ["years", "months", "weeks", "days", "hours", "minutes", "seconds", "milliseconds"]
+    @staticmethod
+    def span(end, **kwargs):
+        kw = ["weeks", "days", "hours", "minutes", "seconds", "milliseconds"]
         if not kwargs:
             kwargs["hours"] = 1
         begin = end - timedelta(**{i: kwargs[i] for i in kwargs if i in kw})
-        return self.service.ledger.channels["data"].range(start=begin, stop=end)
+        return begin, end
+
+    def iter_range(self, begin, end, page=None):
+        """
+        Messages from begin to end, oldest first, fetched lazily in XRANGE pages of `page` entries.
+        Archived entries (if the service has an archive) come first. A partitioned service's streams are
+        merged in id order. Stop iterating to stop reading.
+        """
+        channels = self.service.ledger.data_channels
+        if len(channels) == 1:
+            return self._iter_channel('data', begin, end, page)
+        return heapq.merge(*[self._iter_channel(i, begin, end, page) for i in channels],
+                           key=lambda m: parse_id(m.message_id))
+
+    def _iter_channel(self, channel, begin, end, page=None):
+        db = self.service.ledger.s.db
+        key = self.service.ledger.stream_key(channel)
+        page = page or self.page
+        stop = datetime_to_id(end).split('-')[0]  # bare ms, so the whole last millisecond is included
+
+        batch = db.xrange(key, min=datetime_to_id(begin), max=stop, count=page)
+
+        # older entries may have been moved to the archive, anything still in the stream wins
+        archive = self.service.archive_of(channel)
+        if archive:
+            first = parse_id(batch[0][0]) if batch else None
+            for i in archive.range(begin, end):
+                if first and parse_id(i.message_id) >= first:
+                    break
+                yield i
+
+        while batch:
+            for message_id, data in batch:
+                yield self.service.ledger.message(key, message_id, data)
+            if len(batch) < page:
+                break
+            batch = db.xrange(key, min=f'({batch[-1][0].decode()}', max=stop, count=page)
+
+    def _get_range(self, end, lazy=False, **kwargs):
+        messages = self.iter_range(*self.span(end, **kwargs))
+        return messages if lazy else list(messages)
+
+    def now(self, seconds, lazy=False):
+        end = datetime.now()
+        return self._get_range(end, lazy, seconds=seconds)
 
-    def now(self, seconds):
+    def today(self, lazy=False):
         end = datetime.now()
-        return self._get_range(end, seconds=seconds)
+        midnight = end.replace(hour=0, minute=0, second=0, microsecond=0)
+        return self._get_range(end, lazy, seconds=(end - midnight).total_seconds())
 
-    def yesterday(self):
+    def yesterday(self, lazy=False):
         yesterday = datetime.now() - timedelta(hours=24)
-        return self._get_range(yesterday, hours=24)
-
-    def hours(self, hours):
-        return self._get_range(hours=hours, end=datetime.now())
-
-    def days(self, days):
-        return self._get_range(days=days, end=datetime.now())
+        return self._get_range(yesterday, lazy, hours=24)
+
+    def hours(self, hours, lazy=False):
+        return self._get_range(hours=hours, end=datetime.now(), lazy=lazy)
+
+    def days(self, days, lazy=False):
+        return self._get_range(days=days, end=datetime.now(), lazy=lazy)
+
+
+class ColumnBuilder:
+    """
+    Builds one aligned DataFrame out of messages. Values are gathered per field with their row numbers in
+    typed arrays, then each column is coerced in one step and the datetime index is made from the stream ids.
+
+    :param schema: {field: 'float' | 'int' | 'str' | 'category'}, fields not listed are numeric if every
+        value parses as a number, otherwise strings
+    :param sparse_below: numeric columns filled in fewer than this share of rows become sparse
+    """
+    def __init__(self, schema=None, sparse_below=0.1):
+        self.schema = schema or {}
+        self.sparse_below = sparse_below
+        self.ms = array('q')  # message id milliseconds, one per row
+        self.rows = {}  # field: array('q') of the rows it appears in
+        self.values = {}  # field: [str]
+
+    def add(self, msg: Message):
+        row = len(self.ms)
+        self.ms.append(int(msg.message_id.partition('-')[0]))
+        values = self.values
+        for key, value in msg.data.items():
+            if key in values:
+                values[key].append(value)
+                self.rows[key].append(row)
+            else:
+                values[key] = [value]
+                self.rows[key] = array('q', [row])
+
+    def extend(self, messages):
+        for i in messages:
+            self.add(i)
+        return self
+
+    def column(self, key, n):
+        rows = np.frombuffer(self.rows[key], dtype=np.int64)
+        raw = np.array(self.values[key], dtype=object)
+        kind = self.schema.get(key)
+
+        if kind in (None, 'float', 'int'):
+            numbers = to_numeric(raw, errors='coerce')
+            if kind or not np.isnan(numbers).any():
+                if len(rows) == n:
+                    col = numbers
+                else:
+                    col = np.full(n, np.nan)
+                    col[rows] = numbers
+                if kind == 'int':
+                    if col.dtype.kind == 'f':  # non-integral values are NA, like unparsable ones
+                        col = np.where(np.isfinite(col) & (col == np.floor(col)), col, np.nan)
+                    return Series(col).astype('Int64').array
+                if len(rows) < n * self.sparse_below:
+                    return arrays.SparseArray(col)
+                return col
+
+        col = np.full(n, None, dtype=object)
+        col[rows] = raw
+        return Categorical(col) if kind == 'category' else col
+
+    def index(self):
+        """Naive local times, like walrus' Message.timestamp. The utc offset is looked up once per hour."""
+        ms = np.frombuffer(self.ms, dtype=np.int64)
+        hours, inverse = np.unique(ms // 3600000, return_inverse=True)
+        offsets = np.array([datetime.fromtimestamp(h * 3600).astimezone().utcoffset().total_seconds()
+                            for h in hours.tolist()], dtype=np.int64) * 1000
+        return to_datetime(ms + offsets[inverse] if len(ms) else ms, unit='ms')
+
+    def frame(self):
+        n = len(self.ms)
+        return DataFrame({key: self.column(key, n) for key in self.values}, index=self.index())
 
 
 class BlindDataFrames:
-    def __init__(self, service, chat=False):
+    def __init__(self, service, chat=False, schema=None):
         self.tf = TimeFrames(service)
         self.chat = chat
+        self.schema = schema or {}
 
-    @staticmethod
-    def index_messages(messages):
-        frames = {}
-        index = {}
-
-        def func(msg):
-            for stream_key in msg.data:
-                if stream_key in frames:
-                    frames[stream_key].append(msg.data[stream_key])
-                else:
-                    frames[stream_key] = [msg.data[stream_key]]
-                if stream_key in index:
-                    index[stream_key].append(msg.timestamp)
-                else:
-                    index[stream_key] = [msg.timestamp]
-
-        [func(i) for i in messages]
-
-        dfs = {}
-        for key in index:
-            f = DataFrame(frames, index=index[key])
-            dfs[key] = f
-        return dfs
+    def index_messages(self, messages, schema=None):
+        """One DataFrame, a row per message and a column per field, see ColumnBuilder."""
+        return ColumnBuilder(schema or self.schema).extend(messages).frame()
 
     def today(self):
-        return self.index_messages(self.tf.today())
+        return self.index_messages(self.tf.today(lazy=True))
 
     def yesterday(self):
-        return self.index_messages(self.tf.yesterday())
+        return self.index_messages(self.tf.yesterday(lazy=True))
 
     def hour(self, hours):
-        return self.index_messages(self.tf.hours(hours))
+        return self.index_messages(self.tf.hours(hours, lazy=True))
 
     def now(self, seconds):
-        return self.index_messages(self.tf.now(seconds))
+        return self.index_messages(self.tf.now(seconds, lazy=True))
 
     def days(self, days):
-        return self.index_messages(self.tf.days(days))
+        return self.index_messages(self.tf.days(days, lazy=True))
+
+    def rollup(self, field, resolution='1h', **kwargs):
+        """
+        Resampled frame of a field served from the service's rollups instead of raw messages.
+        Columns are count, sum, min, max, last and mean per bucket, kwargs are a span like days=30.
+        """
+        rollups = self.tf.service.rollups
+        if not rollups:
+            print(f'No "rollup" section for this service.')
+            return None
+
+        begin, end = self.tf.span(datetime.now(), **kwargs)
+        buckets = rollups.buckets(field, resolution, begin, end)
+        f = DataFrame([i[1] for i in buckets], index=[datetime.fromtimestamp(i[0]) for i in buckets],
+                      columns=['count', 'sum', 'min', 'max', 'last'])
+        f['mean'] = f['sum'] / f['count']
+        return f
 
     # def _filter_keys(self, messages: list, key):
     #     keys_in_msgs = set()
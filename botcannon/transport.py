@@ -0,0 +1,91 @@
+import os
+from pathlib import Path
+from urllib.parse import urlparse, unquote
+
+from redis import BlockingConnectionPool
+from redis.sentinel import Sentinel
+from walrus import Database
+
+# connections a process may hold to redis at once, callers wait for a free one beyond that
+MAX_CONNECTIONS = int(os.environ.get('BOTCANNON_MAX_CONNECTIONS', 64))
+POOL_TIMEOUT = float(os.environ.get('BOTCANNON_POOL_TIMEOUT', 20))
+SOCKETS = [Path('./sockets/redis-server.sock'), Path('/run/redis/redis-server.sock')]
+
+_databases = {}  # (url, pid): Database, so a forked process makes its own pool
+
+
+def redis_url(url=None):
+    """
+    Where redis is: `url`, else $BOTCANNON_REDIS, else the first of SOCKETS that exists. One of
+
+        unix:///run/redis/redis-server.sock?db=0
+        redis://[:password@]host:6379/0                          (rediss:// for TLS)
+        redis+sentinel://[:password@]host:26379,host:26380/master_name/0
+    """
+    url = url or os.environ.get('BOTCANNON_REDIS')
+    if url:
+        return url
+    for i in SOCKETS:
+        if i.exists():
+            return f'unix://{i.resolve()}'
+    print(f'No redis socket in {" OR ".join(str(i) for i in SOCKETS)}, set BOTCANNON_REDIS or --redis_url.')
+    exit(1)
+
+
+def parse_sentinel(url):
+    """([(host, port)], master name, {db, password}) of a redis+sentinel:// url."""
+    u = urlparse(url)
+    hosts = []
+    for i in u.netloc.rpartition('@')[2].split(','):
+        host, _, port = i.partition(':')
+        hosts.append((host, int(port or 26379)))
+    path = [i for i in u.path.split('/') if i]
+    if not path:
+        print(f'Sentinel url needs a master name: redis+sentinel://host:26379/master_name/0')
+        exit(1)
+    kwargs = {'db': int(path[1]) if len(path) > 1 else 0}
+    if u.password:
+        kwargs['password'] = unquote(u.password)
+    return hosts, path[0], kwargs
+
+
+def connection_pool(url, max_connections=None):
+    max_connections = max_connections or MAX_CONNECTIONS
+    scheme = url.partition('://')[0]
+    if scheme == 'redis+sentinel':
+        hosts, master, kwargs = parse_sentinel(url)
+        sentinel = Sentinel(hosts, sentinel_kwargs={'password': kwargs.get('password')})
+        # not a blocking pool, past max_connections redis-py raises instead of waiting
+        return sentinel.master_for(master, max_connections=max_connections, **kwargs).connection_pool
+    if scheme in ('redis+cluster', 'cluster'):
+        # walrus' Database (models, streams, consumer groups) is a redis.Redis and can't sit on RedisCluster
+        print('Redis Cluster is not supported, use one primary (with sentinel for failover) per namespace.')
+        exit(1)
+    return BlockingConnectionPool.from_url(url, max_connections=max_connections, timeout=POOL_TIMEOUT)
+
+
+def database(url=None, max_connections=None):
+    """The Database for `url` of this process, shared by everything in it that talks to redis."""
+    url = redis_url(url)
+    key = (url, os.getpid())
+    if key not in _databases:
+        _databases[key] = Database(connection_pool=connection_pool(url, max_connections))
+    return _databases[key]
+
+
+def pool_stats():
+    """{'in_use', 'idle', 'max'} connections over the pools of this process."""
+    stats = {'in_use': 0, 'idle': 0, 'max': 0}
+    for (_, pid), db in list(_databases.items()):
+        if pid != os.getpid():
+            continue
+        pool = db.connection_pool
+        if hasattr(pool, '_in_use_connections'):
+            in_use, idle = len(pool._in_use_connections), len(pool._available_connections)
+        else:  # BlockingConnectionPool, its queue holds idle connections and None for ones not made yet
+            idle = sum(1 for i in list(pool.pool.queue) if i is not None)
+            in_use = len(pool._connections) - idle
+        stats['in_use'] += in_use
+        stats['idle'] += idle
+        stats['max'] += pool.max_connections
+    return stats
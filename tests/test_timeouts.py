@@ -0,0 +1,56 @@
+import threading
+from time import sleep, time
+from types import SimpleNamespace
+
+from botcannon.multiprocess import TaskWorker
+
+
+class SlowTask:
+    def __init__(self):
+        self.cancelled = threading.Event()
+        self.calls = 0
+
+    def task(self, message, **kwargs):
+        self.calls += 1
+        for _ in range(20):
+            if self.cancelled.is_set():
+                return {'out': 'partial'}
+            sleep(0.05)
+        return {'out': 'done'}
+
+
+def test_task_past_its_deadline_fails_the_rest_of_the_read():
+    w = TaskWorker('svc', 10, 3)
+    w.task_timeouts = {'slow': 0.3}
+    task = SlowTask()
+    live = [(SimpleNamespace(message_id=f'{i}-0', data={}), {}) for i in range(3)]
+
+    out, failed = w.compute('slow', task, live)
+
+    assert out == []
+    assert sorted(failed) == ['0-0', '1-0', '2-0']
+    assert 'TaskTimeout' in failed['0-0'] and 'still running' in failed['1-0']
+    assert task.calls == 1  # the hung instance isn't run again
+    assert len(w.hung) == 1
+
+
+def test_message_timeout_is_wall_time_and_a_batch_gets_the_least_left():
+    w = TaskWorker('svc', 10, 3)
+    w.message_timeout = 1.0
+    now = time()
+    w._started = {'0-0': now - 0.6, '1-0': now - 0.2}
+
+    assert 0.3 < w.deadline('t', ['0-0']) <= 0.4
+    assert 0.3 < w.deadline('t', ['0-0', '1-0']) <= 0.4  # not the sum of both
+
+
+def test_spent_budget_fails_the_call_without_a_thread():
+    w = TaskWorker('svc', 10, 3)
+    w.message_timeout = 1.0
+    w._started = {'0-0': time() - 2}
+    live = [(SimpleNamespace(message_id='0-0', data={}), {})]
+
+    out, failed = w.compute('slow', SlowTask(), live)
+
+    assert out == [] and 'spent' in failed['0-0']
+    assert w.hung == [] and not w.hung_tasks